@@ -1,9 +1,14 @@
 import azure.functions as func
 import json
 import math
+import numpy as np
 import redis
 import os
 import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 
 r = redis.StrictRedis(
     host=os.getenv("RedisHost"),
@@ -15,6 +20,9 @@ r = redis.StrictRedis(
 
 app = func.FunctionApp()
 
+# Per-guess reference versions of calculate_distance_batch / score_with_profile.
+# Not used on the scoring path; tests/test_scoring_kernel.py checks the
+# batch kernels against them.
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Haversine formula to calculate distance in km"""
     R = 6371
@@ -37,14 +45,100 @@ def score_city(distance_km: float, max_score: int = 5000, k: float = 0.5) -> int
     score = int(round(max_score * math.exp(-distance_km / k)))
     return max(0, min(max_score, score))
 
-@app.service_bus_queue_trigger(arg_name="msg", queue_name="guesses", connection="ServiceBusConn")
-def process_guess_queue(msg: func.ServiceBusMessage):
+class _AnswerCache:
+    """
+    Per-worker cache of round answers keyed by (game_id, round_no).
+    An answer never changes during a round, so each entry lives for that
+    round's length plus a grace period for late guesses (see _answer_ttl).
+    Missing answers are cached briefly too, so guesses for a round that was
+    never prepared don't all go to Redis.
+    """
+
+    MISSING = object()
+
+    def __init__(self, max_size: int, ttl_seconds: float, negative_ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (lat, lon, profile), MISSING for a cached miss, or None if not cached."""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value: Optional[Tuple[float, float, str]], ttl: Optional[float] = None) -> None:
+        if value is None:
+            ttl = self.negative_ttl_seconds
+        elif ttl is None:
+            ttl = self.ttl_seconds
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value if value is not None else self.MISSING)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+# Upper bound on how long an answer is cached, and the TTL for answers
+# written without a round length
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "120"))
+# Guesses still queued when the round ends are scored against the cached answer
+ANSWER_CACHE_GRACE_SECONDS = float(os.getenv("ANSWER_CACHE_GRACE_SECONDS", "10"))
+
+answer_cache = _AnswerCache(
+    max_size=int(os.getenv("ANSWER_CACHE_SIZE", "1000")),
+    ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+    negative_ttl_seconds=float(os.getenv("ANSWER_CACHE_NEGATIVE_TTL_SECONDS", "2")),
+)
+
+def _answer_ttl(round_seconds) -> float:
+    """
+    An answer is cached for its round's countdown plus the grace period, so an
+    entry for (game_id, round_no) has expired by the time a reused match code
+    could reach that round again: the old game still has to finish, the code
+    go back to the pool, and a new lobby fill up and start.
+    """
+    if not round_seconds:
+        return ANSWER_CACHE_TTL_SECONDS
+    return min(float(round_seconds) + ANSWER_CACHE_GRACE_SECONDS, ANSWER_CACHE_TTL_SECONDS)
+
+def _parse_answer(ans_key: str, ans_raw) -> Tuple[Optional[Tuple[float, float, str]], float]:
+    """Returns ((lat, lon, profile) or None, how long to cache it)."""
+    if not ans_raw:
+        logging.warning(f"process_guess_queue: no answer found in Redis key '{ans_key}'")
+        return None, answer_cache.negative_ttl_seconds
+    try:
+        ans_data = json.loads(ans_raw)
+        ans_lat = float(ans_data["lat"])
+        ans_lon = float(ans_data["lon"])
+        profile = _profile_name(ans_data.get("profile"))
+        logging.info(f"process_guess_queue: answer location=({ans_lat}, {ans_lon}) profile={profile}")
+        return (ans_lat, ans_lon, profile), _answer_ttl(ans_data.get("round_seconds"))
+    except Exception as e:
+        logging.exception(f"process_guess_queue: invalid JSON in answer: {e}")
+        return None, answer_cache.negative_ttl_seconds
+
+def _parse_guess(msg: func.ServiceBusMessage):
     try:
         body = json.loads(msg.get_body().decode("utf-8"))
         logging.info(f"process_guess_queue: received message={body}")
     except Exception as e:
         logging.exception(f"process_guess_queue: failed to parse message body: {e}")
-        return
+        return None
 
     game_id = body.get("game_id")
     player_id = body.get("player_id")
@@ -57,7 +151,7 @@ def process_guess_queue(msg: func.ServiceBusMessage):
             f"process_guess_queue: missing required fields. "
             f"game_id={game_id}, player_id={player_id}, round_no={round_no}"
         )
-        return
+        return None
 
     try:
         player_lat = float(player_lat)
@@ -67,52 +161,195 @@ def process_guess_queue(msg: func.ServiceBusMessage):
             f"process_guess_queue: invalid lat/lon types. "
             f"player_id={player_id} lat={player_lat} lon={player_lon}"
         )
-        return
+        return None
 
-    logging.warning(
-        f"process_guess_queue: game_id={game_id}, player_id={player_id}, guess=({player_lat}, {player_lon}), round_no={round_no}"
-    )
+    return {"game_id": game_id, "player_id": player_id, "lat": player_lat, "lon": player_lon, "round_no": round_no}
 
-    ans_key = f"match:{game_id}:round:{round_no}:answer"
-    try:
-        ans_raw = r.get(ans_key)
-        if not ans_raw:
-            logging.warning(f"process_guess_queue: no answer found in Redis key '{ans_key}'")
-            return
-        logging.info(f"process_guess_queue: fetched answer from Redis key '{ans_key}'")
-    except Exception as e:
-        logging.exception(f"process_guess_queue: failed to read answer from Redis: {e}")
+# Named scoring curves, selected per match via matchSettings.scoringProfile.
+#   exp:    max_score * exp(-d / scale_km)
+#   linear: max_score - d / scale_km  (1 point per scale_km)
+# Keep in sync with SCORING_PROFILES in func_app (direct ingestion).
+SCORING_PROFILES = {
+    "city-strict": {"curve": "exp", "max_score": 5000, "scale_km": 0.25},
+    "city-forgiving": {"curve": "exp", "max_score": 5000, "scale_km": 0.5},
+    "linear": {"curve": "linear", "max_score": 5000, "scale_km": 1.0},
+    "region": {"curve": "exp", "max_score": 5000, "scale_km": 2.0},
+}
+DEFAULT_SCORING_PROFILE = "city-strict"
+SCORING_LUT_POINTS = 4096
+
+def _build_score_lut(profile: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Precomputes the distance -> raw score curve out to where it rounds to 0.
+    np.interp over this replaces an exp() per guess.
+    """
+    max_score = profile["max_score"]
+    scale = profile["scale_km"]
+    if profile["curve"] == "linear":
+        cutoff = max_score * scale
+        return np.array([0.0, cutoff]), np.array([float(max_score), 0.0])
+    cutoff = scale * math.log(2 * max_score)
+    grid = np.linspace(0.0, cutoff, SCORING_LUT_POINTS)
+    return grid, max_score * np.exp(-grid / scale)
+
+SCORE_LUTS = {name: _build_score_lut(profile) for name, profile in SCORING_PROFILES.items()}
+
+def _profile_name(name: Optional[str]) -> str:
+    if name not in SCORING_PROFILES:
+        if name:
+            logging.warning(f"unknown scoring profile '{name}', using {DEFAULT_SCORING_PROFILE}")
+        return DEFAULT_SCORING_PROFILE
+    return name
+
+def score_with_profile(distances_km, profile_name: Optional[str] = None) -> np.ndarray:
+    name = _profile_name(profile_name)
+    grid, table = SCORE_LUTS[name]
+    max_score = SCORING_PROFILES[name]["max_score"]
+    raw = np.interp(np.asarray(distances_km, dtype=np.float64), grid, table, right=0.0)
+    return np.clip(np.rint(raw), 0, max_score).astype(np.int64)
+
+def rescore_round(guesses: list, profile_name: str) -> list:
+    """
+    Re-scores stored round guesses (entries with dist_km, as written to
+    round_guesses / Results) under another profile without recomputing distances.
+    """
+    scores = score_with_profile([g["dist_km"] for g in guesses], profile_name).tolist()
+    return [{**g, "score": score} for g, score in zip(guesses, scores)]
+
+def calculate_distance_batch(lats, lons, ans_lats, ans_lons) -> np.ndarray:
+    """
+    Vectorised calculate_distance. Answers may be scalars (one round) or
+    arrays the same length as the guesses (replays / re-scoring).
+    Same formula as the scalar version so results agree to float rounding.
+    """
+    lat1 = np.asarray(lats, dtype=np.float64)
+    lon1 = np.asarray(lons, dtype=np.float64)
+    lat2 = np.asarray(ans_lats, dtype=np.float64)
+    lon2 = np.asarray(ans_lons, dtype=np.float64)
+    R = 6371
+    d_lat = np.radians(lat2 - lat1)
+    d_lon = np.radians(lon2 - lon1)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(d_lon / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+def score_guesses(lats, lons, ans_lat, ans_lon, profile_name: Optional[str] = None):
+    """
+    Scores every guess for one round answer in a single vectorised pass.
+    Returns (distances_km, scores) as plain lists in the same order as the inputs.
+    """
+    distances = calculate_distance_batch(lats, lons, ans_lat, ans_lon)
+    scores = score_with_profile(distances, profile_name)
+    return distances.tolist(), scores.tolist()
+
+# "python": score guesses here and store them in match:{id}:round_guesses (default)
+# "geo":    GEOADD guesses into match:{id}:round:{n}:geo next to the answer and
+#           let process_scores rank the whole round inside Redis
+SCORING_ENGINE = os.getenv("SCORING_ENGINE", "python")
+ROUND_KEY_TTL_SECONDS = 2 * 60 * 60
+
+def _store_geo_guesses(rounds: dict) -> int:
+    """GEOADDs every guess into its round's GEO set. Returns how many were stored."""
+    stored = 0
+    pipe = r.pipeline(transaction=False)
+    for (game_id, round_no), guesses in rounds.items():
+        geo_key = f"match:{game_id}:round:{round_no}:geo"
+        for g in guesses:
+            pipe.geoadd(geo_key, [g["lon"], g["lat"], g["player_id"]])
+            stored += 1
+        pipe.expire(geo_key, ROUND_KEY_TTL_SECONDS)
+    pipe.execute()
+    return stored
+
+@app.service_bus_queue_trigger(
+    arg_name="msgs",
+    queue_name="guesses",
+    connection="ServiceBusConn",
+    cardinality=func.Cardinality.MANY,
+)
+def process_guess_queue(msgs: List[func.ServiceBusMessage]):
+    """
+    Batch consumer: guesses are grouped by (game_id, round_no) so each round
+    answer is fetched once, scored together, and written back with one HSET
+    per game in a single pipeline.
+    """
+    rounds = {}  # (game_id, round_no) -> [guess]
+    for msg in msgs:
+        parsed = _parse_guess(msg)
+        if parsed:
+            rounds.setdefault((parsed["game_id"], parsed["round_no"]), []).append(parsed)
+
+    if not rounds:
         return
 
-    try:
-        ans_data = json.loads(ans_raw)
-        ans_lat = float(ans_data["lat"])
-        ans_lon = float(ans_data["lon"])
-        logging.info(f"process_guess_queue: answer location=({ans_lat}, {ans_lon})")
-    except Exception as e:
-        logging.exception(f"process_guess_queue: invalid JSON in answer: {e}")
+    if SCORING_ENGINE == "geo":
+        try:
+            stored = _store_geo_guesses(rounds)
+            logging.info(
+                f"process_guess_queue: GEOADDed {stored} guesses across {len(rounds)} rounds "
+                f"({len(msgs) - stored} of {len(msgs)} messages invalid)"
+            )
+        except Exception as e:
+            # GEOADD is idempotent, let Service Bus redeliver the batch
+            logging.exception(f"process_guess_queue: failed to GEOADD guesses: {e}")
+            raise
         return
 
-    distance = calculate_distance(player_lat, player_lon, ans_lat, ans_lon)
+    answers = {key: answer_cache.get(key) for key in rounds}
+    to_fetch = [key for key, ans in answers.items() if ans is None]
+    if to_fetch:
+        ans_keys = [f"match:{game_id}:round:{round_no}:answer" for game_id, round_no in to_fetch]
+        try:
+            fetched = r.mget(ans_keys)
+        except Exception as e:
+            # Fail the invocation so Service Bus redelivers the batch instead of completing it
+            logging.exception(f"process_guess_queue: failed to read answers from Redis: {e}")
+            raise
+        for key, ans_key, ans_raw in zip(to_fetch, ans_keys, fetched):
+            answer, ttl = _parse_answer(ans_key, ans_raw)
+            answer_cache.set(key, answer, ttl)
+            answers[key] = answer if answer is not None else _AnswerCache.MISSING
+
+    logging.warning(
+        f"process_guess_queue: batch of {len(msgs)} messages across {len(rounds)} rounds, "
+        f"fetched {len(to_fetch)} answers, answer cache hit_rate={answer_cache.hit_rate():.2f}"
+    )
+
+    writes = {}  # guesses_key -> {player_id: guess JSON}
+    for (game_id, round_no), guesses in rounds.items():
+        answer = answers[(game_id, round_no)]
+        if answer is _AnswerCache.MISSING:
+            continue
+        ans_lat, ans_lon, profile = answer
 
-    # City-only scoring: make it much harder to score highly unless you are very close.
-    # Tuning knob: k (km). Smaller = harsher, larger = more forgiving.
-    score = score_city(distance, max_score=5000, k=0.25)
+        distances, scores = score_guesses(
+            [g["lat"] for g in guesses], [g["lon"] for g in guesses], ans_lat, ans_lon, profile
+        )
 
-    logging.info(f"process_guess_queue: calculated distance={round(distance, 3)}km, score={score}")
+        guesses_key = f"match:{game_id}:round_guesses"
+        entries = writes.setdefault(guesses_key, {})
+        for g, distance, score in zip(guesses, distances, scores):
+            logging.info(
+                f"process_guess_queue: player_id={g['player_id']} distance={round(distance, 3)}km, score={score}"
+            )
+            entries[g["player_id"]] = json.dumps({
+                "player_id": g["player_id"],
+                "dist_km": round(distance, 2),
+                "score": score
+            })
 
-    guess_entry = {
-        "player_id": player_id,
-        "dist_km": round(distance, 2),
-        "score": score
-    }
+    if not writes:
+        return
 
-    guesses_key = f"match:{game_id}:round_guesses"
     try:
-        r.hset(guesses_key, player_id, json.dumps(guess_entry))
-        logging.info(f"process_guess_queue: stored guess in Redis key '{guesses_key}' for player_id={player_id}")
+        pipe = r.pipeline(transaction=False)
+        for guesses_key, entries in writes.items():
+            pipe.hset(guesses_key, mapping=entries)
+        pipe.execute()
+        logging.info(f"process_guess_queue: stored {sum(len(e) for e in writes.values())} guesses in {len(writes)} games")
     except Exception as e:
-        logging.exception(f"process_guess_queue: failed to write guess to Redis: {e}")
-        return
+        # HSET per player is idempotent, so a redelivered batch just writes the same guesses again
+        logging.exception(f"process_guess_queue: failed to write guesses to Redis: {e}")
+        raise
 
     logging.info("process_guess_queue: completed successfully")
@@ -3,11 +3,14 @@ import azure.functions as func
 import azure.durable_functions as df
 import json
 import logging
+import math
 import random
 from datetime import timedelta
 import os
 import redis
+import threading
 from azure.cosmos import CosmosClient
+from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
 
 app = df.DFApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -25,6 +28,29 @@ cosmos_client = CosmosClient.from_connection_string(COSMOS_STR)
 db = cosmos_client.get_database_client(DB_NAME)
 places_col = db.get_container_client(PLACES_CONTAINER)
 results_col = db.get_container_client(RESULTS_CONTAINER)
+# "python": guesses arrive pre-scored in match:{id}:round_guesses (default)
+# "geo":    guesses are GEOADDed next to the answer and ranked here with GEORADIUSBYMEMBER
+SCORING_ENGINE = os.getenv("SCORING_ENGINE", "python")
+GEO_ANSWER_MEMBER = "__answer__"
+ROUND_KEY_TTL_SECONDS = 2 * 60 * 60
+
+# Same curves as SCORING_PROFILES in background_func_app
+SCORING_PROFILES = {
+    "city-strict": {"curve": "exp", "max_score": 5000, "scale_km": 0.25},
+    "city-forgiving": {"curve": "exp", "max_score": 5000, "scale_km": 0.5},
+    "linear": {"curve": "linear", "max_score": 5000, "scale_km": 1.0},
+    "region": {"curve": "exp", "max_score": 5000, "scale_km": 2.0},
+}
+DEFAULT_SCORING_PROFILE = "city-strict"
+
+def _score_distance(distance_km: float, profile_name: str) -> int:
+    profile = SCORING_PROFILES.get(profile_name) or SCORING_PROFILES[DEFAULT_SCORING_PROFILE]
+    if profile["curve"] == "linear":
+        raw = profile["max_score"] - distance_km / profile["scale_km"]
+    else:
+        raw = profile["max_score"] * math.exp(-distance_km / profile["scale_km"])
+    return max(0, min(profile["max_score"], int(round(raw))))
+
 # Allow local runs without Redis configured
 r = None
 if REDIS_HOST and "your-redis-host" not in REDIS_HOST:
@@ -60,11 +86,25 @@ def game_orchestrator(context: df.DurableOrchestrationContext):
     time_to_wait = input_data.get("time", 30)
     logging.warning(f"game_orchestrator: Starting game_id={game_id}")
     num_rounds = input_data.get("rounds", 3)
+    scoring_profile = input_data.get("scoringProfile")
+
+    # Every round's place and answer is set up once, before the first round
+    match_setup = yield context.call_activity("prepare_match", {
+        "game_id": game_id,
+        "rounds": num_rounds,
+        "round_seconds": time_to_wait,
+        "scoring_profile": scoring_profile,
+    })
+
+    for round_num, round_setup in enumerate(match_setup["rounds"], start=1):
+
+        # Re-sign only if the admin took long enough between rounds for the SAS to lapse
+        now = context.current_utc_datetime.replace(tzinfo=None)
+        expires_at = datetime.datetime.fromisoformat(round_setup["image_expires_at"])
+        if expires_at < now + timedelta(seconds=time_to_wait):
+            signed = yield context.call_activity("sign_place_image", {"blob": round_setup["blob"], "seconds": time_to_wait})
+            round_setup = {**round_setup, **signed}
 
-    for round_num in range(1, num_rounds + 1):
-    
-        round_setup = yield context.call_activity("prepare_round", {"game_id": game_id, "round": round_num})
-        
         yield context.call_activity("signalr_broadcast", {
             "game_id": game_id,
             "target": "newRound",
@@ -85,7 +125,7 @@ def game_orchestrator(context: df.DurableOrchestrationContext):
             "arguments": ["Time is up!"]
         })
 
-        round_results = yield context.call_activity("process_scores", game_id)
+        round_results = yield context.call_activity("process_scores", {"game_id": game_id, "round": round_num})
         
         yield context.call_activity("signalr_broadcast", {
             "game_id": game_id,
@@ -108,17 +148,49 @@ def game_orchestrator(context: df.DurableOrchestrationContext):
 
 # ACTIVITIES
 
-@app.activity_trigger(input_name="params")
-def prepare_round(params: dict):
-    """
-    Logic for Steps 2, 3, 4: 
-    - Picks a location from CosmosDB
-    - Generates a Blob SAS token
-    - Saves the 'answer' to Redis for score validation later
-    """
-    game_id = params['game_id']
-    round_num = params['round']
+# Place index in Redis, kept up to date by create_place in func_app:
+#   places:ids    SET     every place id
+#   places:meta   HASH    place id -> JSON {id, location, blob}
+#   places:ready  STRING  set once places:ids holds the whole catalogue
+# A match draws all its rounds with one SRANDMEMBER (positive count, so
+# distinct ids): O(rounds), and no place twice in a game unless the catalogue
+# is smaller than the match.
+PLACE_IDS_KEY = "places:ids"
+PLACE_META_KEY = "places:meta"
+PLACE_INDEX_READY_KEY = "places:ready"
 
+def _rebuild_place_index() -> int:
+    places = list(places_col.query_items(
+        query="SELECT c.id, c.location, c.blob FROM c",
+        enable_cross_partition_query=True,
+    ))
+    if places:
+        pipe = r.pipeline(transaction=False)
+        pipe.sadd(PLACE_IDS_KEY, *[p["id"] for p in places])
+        pipe.hset(PLACE_META_KEY, mapping={p["id"]: json.dumps(p) for p in places})
+        pipe.set(PLACE_INDEX_READY_KEY, datetime.datetime.utcnow().isoformat())
+        pipe.execute()
+    logging.warning(f"prepare_match: rebuilt place index with {len(places)} places")
+    return len(places)
+
+def _draw_places(count: int) -> list:
+    """Draws count distinct places (as far as the catalogue allows) from the place index."""
+    pipe = r.pipeline(transaction=False)
+    pipe.exists(PLACE_INDEX_READY_KEY)
+    pipe.srandmember(PLACE_IDS_KEY, count)
+    ready, ids = pipe.execute()
+    if not ready:
+        if _rebuild_place_index() == 0:
+            return []
+        ids = r.srandmember(PLACE_IDS_KEY, count)
+    ids = ids or []
+    if len(ids) < count:
+        # Catalogue smaller than the match, repeats are unavoidable
+        ids += r.srandmember(PLACE_IDS_KEY, -(count - len(ids)))
+    metas = r.hmget(PLACE_META_KEY, ids)
+    return [json.loads(meta) for meta in metas if meta]
+
+def _random_place_from_cosmos():
     # Randomly pick any document from the container
     total_items = list(places_col.query_items(
         query="SELECT VALUE COUNT(1) FROM c",
@@ -126,64 +198,211 @@ def prepare_round(params: dict):
     ))
     total_count = total_items[0] if total_items else 0
     if total_count == 0:
-        logging.error("prepare_round: No places found in Cosmos container")
+        logging.error("prepare_match: No places found in Cosmos container")
         raise Exception("No places found in Cosmos container")
 
     random_index = random.randint(0, total_count - 1)
     query = f"SELECT * FROM c OFFSET {random_index} LIMIT 1"
-    logging.warning(f"prepare_round: game_id={game_id} round={round_num} selecting random place at index {random_index} of {total_count}")
+    logging.warning(f"prepare_match: selecting random place at index {random_index} of {total_count}")
     items = list(places_col.query_items(
         query=query,
         enable_cross_partition_query=True,
     ))
+    return items[0]
 
-    place = items[0]
-    logging.warning(f"prepare_round: selected place id={place.get('id')}")
+# How long to allow per round (beyond the countdown) when pre-signing image URLs
+ROUND_GAP_SECONDS = int(os.getenv("ROUND_GAP_SECONDS", "60"))
 
+@app.activity_trigger(input_name="params")
+def prepare_match(params: dict):
+    """
+    Sets up every round of a match in one go at game start:
+    - Draws all places from the place index at once
+    - Writes every round's answer to Redis in one pipeline
+    - Signs each image URL with an expiry matched to when its round should run
+    Returns {"rounds": [descriptor, ...]} in round order.
+    """
+    game_id = params["game_id"]
+    num_rounds = params["rounds"]
+    round_seconds = params.get("round_seconds", 30)
 
-    answer_key = f"match:{game_id}:round:{round_num}:answer"
-    coords = {"lat": place["location"]["lat"], "lon": place["location"]["lon"]}
+    places = None
     if r:
         try:
-            r.set(answer_key, json.dumps(coords))
-            logging.warning(f"prepare_round: cached answer in Redis key='{answer_key}'")
+            places = _draw_places(num_rounds)
         except Exception as e:
-            logging.warning(f"Redis not available, skipping answer cache: {e}")
-
-    from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
-    blob_service_client = BlobServiceClient.from_connection_string(BLOB_STR)
-    blob_container = place["blob"]["container"]
-    blob_name = place["blob"]["name"]
-    blob_client = blob_service_client.get_blob_client(container=blob_container, blob=blob_name)
-    sas_token = generate_blob_sas(
-        account_name=blob_service_client.account_name,
-        container_name=blob_container,
-        blob_name=blob_name,
-        account_key=blob_service_client.credential.account_key,
-        permission=BlobSasPermissions(read=True),
-        expiry=datetime.datetime.utcnow() + timedelta(minutes=5)
-    )
-
-    signed_url = f"{blob_client.url}?{sas_token}"
-    logging.warning("prepare_round: generated SAS URL for image")
+            logging.warning(f"prepare_match: place index unavailable, falling back to Cosmos: {e}")
+    places = places or []
+    while len(places) < num_rounds:
+        places.append(_random_place_from_cosmos())
+
+    by_round = dict(enumerate(places, start=1))
+    _store_answers(game_id, by_round, params.get("scoring_profile"), round_seconds)
+
+    start = datetime.datetime.utcnow()
+    rounds = []
+    for round_num, place in by_round.items():
+        expires_at = start + timedelta(seconds=round_num * (round_seconds + ROUND_GAP_SECONDS)) + timedelta(minutes=5)
+        rounds.append({**_place_descriptor(place, round_num, expires_at), "round": round_num})
+
+    logging.warning(f"prepare_match: game_id={game_id} prepared {len(rounds)} rounds")
+    return {"rounds": rounds}
+
+@app.activity_trigger(input_name="params")
+def sign_place_image(params: dict):
+    """Issues a fresh SAS URL for a round image whose pre-signed URL is about to expire."""
+    expires_at = datetime.datetime.utcnow() + timedelta(seconds=params["seconds"]) + timedelta(minutes=5)
+    blob = params["blob"]
+    return {
+        "image_url": _sign_blob_url(blob["container"], blob["name"], expires_at),
+        "image_expires_at": expires_at.isoformat(),
+    }
+
+def _store_answers(game_id: str, places_by_round: dict, scoring_profile, round_seconds: int) -> None:
+    """Saves each round's answer (and GEO member) to Redis in one pipeline."""
+    if not r:
+        return
+    try:
+        pipe = r.pipeline(transaction=False)
+        for round_num, place in places_by_round.items():
+            answer_key = f"match:{game_id}:round:{round_num}:answer"
+            coords = {"lat": place["location"]["lat"], "lon": place["location"]["lon"]}
+            if scoring_profile:
+                # Read by the guess scorers to pick the match's scoring curve
+                coords["profile"] = scoring_profile
+            if round_seconds:
+                # Lets the guess scorers cache the answer for about one round
+                coords["round_seconds"] = round_seconds
+            pipe.set(answer_key, json.dumps(coords), ex=ROUND_KEY_TTL_SECONDS)
+            if SCORING_ENGINE == "geo":
+                geo_key = f"match:{game_id}:round:{round_num}:geo"
+                pipe.geoadd(geo_key, [coords["lon"], coords["lat"], GEO_ANSWER_MEMBER])
+                pipe.expire(geo_key, ROUND_KEY_TTL_SECONDS)
+        pipe.execute()
+        logging.warning(f"cached {len(places_by_round)} answers in Redis for game_id={game_id}")
+    except Exception as e:
+        logging.warning(f"Redis not available, skipping answer cache: {e}")
+
+class _SasSigner:
+    """
+    Shared across activities: one BlobServiceClient for the worker, and each
+    image URL reused until it is about to expire, so signing on a warm
+    worker is usually a dict lookup.
+    """
+
+    def __init__(self, connection_string: str, max_size: int = 5000):
+        self._connection_string = connection_string
+        self._service = None
+        self.max_size = max_size
+        self._urls = {}
+        self._lock = threading.Lock()
+
+    def _blob_service(self) -> BlobServiceClient:
+        if self._service is None:
+            self._service = BlobServiceClient.from_connection_string(self._connection_string)
+        return self._service
+
+    def url(self, container: str, blob_name: str, valid_until: datetime.datetime) -> str:
+        key = (container, blob_name)
+        with self._lock:
+            cached = self._urls.get(key)
+        if cached and cached[0] >= valid_until:
+            return cached[1]
+
+        # Sign for at least SAS_TTL_MINUTES so other matches can reuse the URL
+        expiry = max(valid_until, datetime.datetime.utcnow() + timedelta(minutes=SAS_TTL_MINUTES))
+        service = self._blob_service()
+        blob_client = service.get_blob_client(container=container, blob=blob_name)
+        sas_token = generate_blob_sas(
+            account_name=service.account_name,
+            container_name=container,
+            blob_name=blob_name,
+            account_key=service.credential.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=expiry
+        )
+        url = f"{blob_client.url}?{sas_token}"
+
+        with self._lock:
+            self._urls.pop(key, None)
+            self._urls[key] = (expiry, url)
+            while len(self._urls) > self.max_size:
+                self._urls.pop(next(iter(self._urls)))
+        return url
 
+SAS_TTL_MINUTES = int(os.getenv("SAS_TTL_MINUTES", "30"))
+sas_signer = _SasSigner(BLOB_STR)
+
+def _sign_blob_url(container: str, blob_name: str, expires_at: datetime.datetime) -> str:
+    return sas_signer.url(container, blob_name, expires_at)
+
+def _place_descriptor(place: dict, round_num: int, expires_at: datetime.datetime) -> dict:
+    blob = {"container": place["blob"]["container"], "name": place["blob"]["name"]}
     return {
-        "image_url": signed_url,
-        "round": round_num,
-        "location_id": place['id']
+        "location_id": place["id"],
+        "blob": blob,
+        "image_url": _sign_blob_url(blob["container"], blob["name"], expires_at),
+        "image_expires_at": expires_at.isoformat(),
     }
 
-@app.activity_trigger(input_name="game_id")
-def process_scores(game_id: str):
+# Every member of a round's GEO set with its distance from the answer, nearest
+# first, or {} when the answer member is missing (GEORADIUSBYMEMBER would
+# error). GEORADIUSBYMEMBER rather than GEOSEARCH, which needs Redis 6.2.
+GEO_RANK_LUA = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+  return {}
+end
+return redis.call('GEORADIUSBYMEMBER', KEYS[1], ARGV[1], 20038, 'km', 'WITHDIST', 'ASC')
+"""
+geo_rank_script = r.register_script(GEO_RANK_LUA) if r else None
+
+def _geo_round_guesses(game_id: str, round_num: int) -> dict:
+    """
+    Ranks a whole round in one Redis round trip: every guess with its
+    distance from the answer member, nearest first. Scores are then derived
+    in one pass. Returns the same shape as round_guesses, so a round whose
+    answer was never stored has no guesses, as with the python engine.
+    GEO coordinates are stored as 52-bit geohashes (well under 1m error).
+    """
+    geo_key = f"match:{game_id}:round:{round_num}:geo"
+    pipe = r.pipeline(transaction=False)
+    pipe.get(f"match:{game_id}:round:{round_num}:answer")
+    geo_rank_script(keys=[geo_key], args=[GEO_ANSWER_MEMBER], client=pipe)
+    ans_raw, ranked = pipe.execute()
+
+    if not ranked:
+        logging.warning(f"_geo_round_guesses: no answer member in '{geo_key}', round has no guesses")
+        return {}
+
+    profile = (json.loads(ans_raw).get("profile") if ans_raw else None) or DEFAULT_SCORING_PROFILE
+    guesses = {}
+    for player_id, distance in ranked:
+        if player_id == GEO_ANSWER_MEMBER:
+            continue
+        distance = float(distance)
+        guesses[player_id] = json.dumps({
+            "player_id": player_id,
+            "dist_km": round(distance, 2),
+            "score": _score_distance(distance, profile),
+        })
+    return guesses
+
+@app.activity_trigger(input_name="params")
+def process_scores(params: dict):
+    game_id, round_num = params["game_id"], params["round"]
     logging.info(f"process_scores: start for game_id={game_id}")
     if r is None:
         logging.warning("process_scores: Redis not configured; aborting")
         raise Exception("Redis not configured")
 
-    guesses_key = f"match:{game_id}:round_guesses"
+    use_geo = SCORING_ENGINE == "geo"
+    guesses_key = f"match:{game_id}:round:{round_num}:geo" if use_geo else f"match:{game_id}:round_guesses"
     scores_key = f"match:{game_id}:scores"
     try:
-        all_guesses_raw = r.hgetall(guesses_key)
+        if use_geo:
+            all_guesses_raw = _geo_round_guesses(game_id, round_num)
+        else:
+            all_guesses_raw = r.hgetall(guesses_key)
         logging.warning(f"process_scores: fetched {len(all_guesses_raw)} guesses from '{guesses_key}'")
     except Exception as e:
         logging.exception(f"process_scores: failed to read guesses from Redis key '{guesses_key}': {e}")
@@ -291,11 +510,12 @@ def final_scores_to_cosmos(payload: dict):
 @app.generic_output_binding(arg_name="signalRMessages", type="signalR", hubName="test", connectionStringSetting="SignalRConnection")
 def signalr_broadcast(payload: dict, signalRMessages: func.Out[str]):
     """
-    Generic SignalR broadcaster
+    Generic SignalR broadcaster, scoped to the match's group (its matchCode)
     """
     
     message = {
         "target": payload['target'],
-        "arguments": payload['arguments']
+        "arguments": payload['arguments'],
+        "groupName": payload['game_id']
     }
     signalRMessages.set(json.dumps(message))
@@ -8,12 +8,20 @@ import uuid
 import bcrypt
 import base64
 import binascii
+import redis
 import requests
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import queue
 from typing import Any, Dict, Optional
 from azure.storage.blob import BlobServiceClient, ContentSettings
 from azure.cosmos import exceptions
 
 from azure.cosmos import CosmosClient, exceptions
+from azure.core import MatchConditions
 from azure.servicebus import ServiceBusClient, ServiceBusMessage
 
 from azure.storage.blob import generate_blob_sas, BlobSasPermissions
@@ -33,6 +41,8 @@ MATCHES = os.environ.get("COSMOS_MATCHES_CONTAINER", "matches")
 PLACES = os.environ.get("COSMOS_PLACES_CONTAINER", "places")
 LEASES = os.environ.get("COSMOS_LEASES_CONTAINER", "leases")
 RESULTS = os.environ.get("COSMOS_RESULTS_CONTAINER", "Results")
+USERNAMES = os.environ.get("COSMOS_USERNAMES_CONTAINER", "usernames")
+FINALIZATIONS = os.environ.get("COSMOS_FINALIZATIONS_CONTAINER", "finalizations")
 
 client = CosmosClient.from_connection_string(COSMOS_CONNECTION_STRING)
 db = client.get_database_client(DB_NAME)
@@ -43,6 +53,8 @@ leaderboard_container = db.get_container_client(LEADERBOARD)
 matches_container = db.get_container_client(MATCHES)
 places_container = db.get_container_client(PLACES)
 results_container = db.get_container_client(RESULTS)
+usernames_container = db.get_container_client(USERNAMES)
+finalizations_container = db.get_container_client(FINALIZATIONS)
 
 signalR_connection_string = os.environ["AZURE_SIGNALR_CONNECTION_STRING"]
 signalr_endpoint = os.environ["SIGNALR_ENDPOINT"]
@@ -54,60 +66,610 @@ BLOB_CONTAINER_NAME = os.environ.get("BLOB_CONTAINER_NAME", "places-images")
 blob_service = BlobServiceClient.from_connection_string(AZURE_STORAGE_CONNECTION_STRING)
 blob_container = blob_service.get_container_client(BLOB_CONTAINER_NAME)
 
+# ----- Redis init -----
+REDIS_HOST = os.environ.get("RedisHost")
+REDIS_PORT = int(os.environ.get("RedisPort", 6380))
+REDIS_KEY = os.environ.get("RedisKey")
+
+# Allow local runs without Redis configured, everything falls back to Cosmos
+r = None
+if REDIS_HOST:
+    r = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_KEY, ssl=True, decode_responses=True)
+
+# ----- User cache -----
+class _TTLCache:
+    """
+    Small thread-safe LRU cache with a per-entry TTL.
+    Lives for the lifetime of the worker, so warm invocations skip Cosmos.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "2000"))
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", "300"))
+
+# userId -> user doc, and normalised username -> userId
+user_cache = _TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+username_cache = _TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
+# Usernames the unindexed-user fallback found nothing for. Only skips that
+# cross-partition query; the index itself is still read on every miss, so a
+# name registered meanwhile (on any worker) is found straight away.
+USERNAME_MISS_TTL_SECONDS = float(os.environ.get("USERNAME_MISS_TTL_SECONDS", "60"))
+username_miss_cache = _TTLCache(USER_CACHE_SIZE, USERNAME_MISS_TTL_SECONDS)
+
+def _invalidate_user(user_id: str, username: Optional[str] = None) -> None:
+    # Call whenever a user doc or its index entry is written or removed so
+    # other lookups don't serve a stale profile
+    user_cache.delete(user_id)
+    if username:
+        username_cache.delete(username)
+
+def _user_cache_stats() -> Dict[str, Dict[str, int]]:
+    return {"users": user_cache.stats(), "usernames": username_cache.stats()}
+
+# ----- Per-player fan-out -----
+# The Cosmos SDK is sync, so per-player round trips run on a shared thread pool
+PLAYER_FANOUT_WORKERS = int(os.environ.get("PLAYER_FANOUT_WORKERS", "8"))
+player_executor = ThreadPoolExecutor(max_workers=PLAYER_FANOUT_WORKERS, thread_name_prefix="player")
+
 # ----- Helpers -----
-def _json(payload: Dict[str, Any], status: int = 200) -> func.HttpResponse:
-    return func.HttpResponse(json.dumps(payload), status_code=status, mimetype="application/json")
+def _json(payload: Dict[str, Any], status: int = 200, headers: Optional[Dict[str, str]] = None) -> func.HttpResponse:
+    return func.HttpResponse(json.dumps(payload), status_code=status, mimetype="application/json", headers=headers)
 
 def _now_z() -> str:
     return datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
 
-def _month_scope() -> str:
-    return "month:" + datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m")
+# ----- Score scopes -----
+# name -> {"key": fn(now) -> scope id or None when inactive, "ttl": seconds or None}
+# Every active scope for a player is written in the same batch, so adding a
+# window costs nothing extra per game. Windowed docs carry a Cosmos ttl (the
+# scores and leaderboard containers need TTL enabled) and expire on their own;
+# the scope's _top snapshot has no ttl and stays behind as the archived standings.
+SCORE_SCOPES: Dict[str, Dict[str, Any]] = {}
+
+def register_scope(name: str, key_fn, ttl_seconds: Optional[int] = None) -> None:
+    SCORE_SCOPES[name] = {"key": key_fn, "ttl": ttl_seconds}
+
+def _iso_week(now: datetime.datetime) -> str:
+    year, week, _ = now.isocalendar()
+    return f"week:{year}-W{week:02d}"
+
+def _season_key(name: str, start: str, end: str):
+    start_dt = datetime.datetime.fromisoformat(start).replace(tzinfo=datetime.timezone.utc)
+    end_dt = datetime.datetime.fromisoformat(end).replace(tzinfo=datetime.timezone.utc)
+    return lambda now: f"season:{name}" if start_dt <= now < end_dt else None
+
+register_scope("alltime", lambda now: "alltime")
+register_scope("month", lambda now: now.strftime("month:%Y-%m"))
+register_scope("week", _iso_week, ttl_seconds=8 * 7 * 24 * 60 * 60)
+register_scope("day", lambda now: now.strftime("day:%Y-%m-%d"), ttl_seconds=7 * 24 * 60 * 60)
+
+def _register_seasons(raw: str) -> None:
+    """
+    Registers custom seasons, e.g. SCORE_SEASONS='[{"name": "spring-2026", "start": "2026-03-01", "end": "2026-06-01"}]'.
+    Runs at import, so a bad setting is logged and skipped rather than taking every endpoint down.
+    """
+    try:
+        seasons = json.loads(raw)
+        if not isinstance(seasons, list):
+            raise ValueError("expected a JSON list")
+    except ValueError:
+        logging.exception("SCORE_SEASONS is not a JSON list of seasons, ignoring it")
+        return
+    for season in seasons:
+        try:
+            register_scope(f"season:{season['name']}", _season_key(season["name"], season["start"], season["end"]))
+        except (TypeError, KeyError, ValueError):
+            logging.exception(f"SCORE_SEASONS: skipping invalid season {season!r}")
+
+_register_seasons(os.environ.get("SCORE_SEASONS", "[]"))
+
+def _score_scopes(now: Optional[datetime.datetime] = None) -> Dict[str, Optional[int]]:
+    """Active scope ids for the given time, mapped to their ttl."""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    scopes = {}
+    for entry in SCORE_SCOPES.values():
+        key = entry["key"](now)
+        if key:
+            scopes[key] = entry["ttl"]
+    return scopes
+
+def _resolve_scope(scope: str) -> str:
+    # Accepts a registered name ("week") for the current window, or a concrete scope id
+    if scope in SCORE_SCOPES:
+        return SCORE_SCOPES[scope]["key"](datetime.datetime.now(datetime.timezone.utc)) or scope
+    return scope
 
 def _norm_username(u: str) -> str:
     return u.lower().strip()
 
 def _get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
-    # Parameterised query to avoid injection
+    user_id = username_cache.get(username)
+    if user_id is not None:
+        user = _get_user_by_user_id(user_id)
+        if user is not None:
+            return user
+        # The entry was reclaimed from an orphaned reservation since it was cached
+        username_cache.delete(username)
+    # username -> userId index, PK is /id (the normalised username)
+    try:
+        entry = usernames_container.read_item(item=username, partition_key=username)
+        user_id = entry["userId"]
+    except exceptions.CosmosResourceNotFoundError:
+        user_id = _index_unindexed_user(username)
+        if user_id is None:
+            return None
+    username_cache.set(username, user_id)
+    return _get_user_by_user_id(user_id)
+
+def _index_unindexed_user(username: str) -> Optional[str]:
+    """
+    Fallback for users created before the username index existed (or before
+    backfill_username_index has run): finds them with the old cross-partition
+    query and adds their index entry, so the next lookup is a point read.
+    Names it doesn't find are remembered for USERNAME_MISS_TTL_SECONDS.
+    """
+    if username_miss_cache.get(username):
+        return None
     query = "SELECT TOP 1 * FROM c WHERE c.username = @u"
     params = [{"name": "@u", "value": username}]
-    results = list(users_container.query_items(query=query, parameters=params, enable_cross_partition_query=True))
-    return results[0] if results else None
+    found = list(users_container.query_items(query=query, parameters=params, enable_cross_partition_query=True))
+    if not found:
+        username_miss_cache.set(username, True)
+        return None
+    user = found[0]
+    if not _reserve_username(username, user["id"]):
+        # Indexed concurrently, the index entry wins
+        entry = usernames_container.read_item(item=username, partition_key=username)
+        return entry["userId"]
+    user_cache.set(user["id"], user)
+    return user["id"]
 
 def _get_user_by_user_id(user_id: str) -> Optional[Dict[str, Any]]:
-    query = "SELECT TOP 1 * FROM c WHERE c.id = @u"
-    params = [{"name": "@u", "value": user_id}]
-    results = list(users_container.query_items(
-        query=query,
-        parameters=params,
-        enable_cross_partition_query=True
-    ))
-    return results[0] if results else None
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    try:
+        # PK is /id
+        user = users_container.read_item(item=user_id, partition_key=user_id)
+    except exceptions.CosmosResourceNotFoundError:
+        return None
+    user_cache.set(user_id, user)
+    return user
+
+def _reserve_username(username: str, user_id: str) -> bool:
+    """
+    Claims a username in the index. Returns False if it is already taken.
+    The create is conditional, so two concurrent registrations can't both win.
+    """
+    try:
+        usernames_container.create_item({"id": username, "username": username, "userId": user_id})
+        return True
+    except exceptions.CosmosResourceExistsError:
+        return False
+
+# How long a registration has to create its user doc after reserving the name.
+# An index entry older than this whose user doc doesn't exist was left by a
+# registration that died in between, and the name can be claimed again.
+USERNAME_RESERVATION_SECONDS = int(os.environ.get("USERNAME_RESERVATION_SECONDS", "60"))
+
+def _reclaim_orphaned_username(username: str, user_id: str) -> bool:
+    """
+    Points a taken username at user_id if its entry is an orphaned
+    reservation. The replace is guarded by the entry's ETag, so only one
+    registration can reclaim it. Returns False if the name is really taken.
+    """
+    try:
+        entry = usernames_container.read_item(item=username, partition_key=username)
+    except exceptions.CosmosResourceNotFoundError:
+        # Released since the create failed
+        return _reserve_username(username, user_id)
+    if entry.get("_ts", 0) > time.time() - USERNAME_RESERVATION_SECONDS:
+        return False
+    try:
+        users_container.read_item(item=entry["userId"], partition_key=entry["userId"])
+        return False
+    except exceptions.CosmosResourceNotFoundError:
+        pass
+    try:
+        usernames_container.replace_item(
+            item=username,
+            body={"id": username, "username": username, "userId": user_id},
+            etag=entry["_etag"],
+            match_condition=MatchConditions.IfNotModified,
+        )
+    except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceNotFoundError):
+        return False
+    logging.warning(f"Reclaimed username '{username}' from orphaned reservation for {entry['userId']}")
+    return True
 
-def _inc_score(user_id: str, scope: str, display_name: str, delta: int) -> None:
+SCORE_WRITE_RETRIES = int(os.environ.get("SCORE_WRITE_RETRIES", "3"))
+
+def _score_batch_ops(user_id: str, scopes: Dict[str, Optional[int]], display_name: str, delta: int, existing: set) -> list:
     now = _now_z()
+    ops = []
+    for scope, ttl in scopes.items():
+        if scope in existing:
+            # incr is applied server side, so concurrent games can't lose updates
+            ops.append(("patch", (scope, [
+                {"op": "incr", "path": "/score", "value": int(delta)},
+                {"op": "set", "path": "/displayName", "value": display_name},
+                {"op": "set", "path": "/updatedAt", "value": now},
+            ])))
+        else:
+            doc = {
+                "id": scope,          # id is just the scope now
+                "userId": user_id,
+                "scope": scope,
+                "score": int(delta),
+                "displayName": display_name,
+                "updatedAt": now,
+            }
+            if ttl:
+                doc["ttl"] = ttl
+            ops.append(("create", (doc,)))
+    return ops
+
+def _existing_score_scopes(user_id: str, scopes: Dict[str, Optional[int]]) -> set:
+    query = "SELECT VALUE c.id FROM c WHERE ARRAY_CONTAINS(@scopes, c.id)"
+    params = [{"name": "@scopes", "value": list(scopes)}]
+    return set(scores_container.query_items(query=query, parameters=params, partition_key=user_id))
+
+def _applied_marker(user_id: str, game_key: str) -> Dict[str, Any]:
+    # Lives next to the user's score docs so it commits in the same batch
+    return {
+        "id": f"applied:{game_key}",
+        "userId": user_id,
+        "type": "applied",
+        "gameKey": game_key,
+        "ttl": FINALIZATION_TTL_SECONDS,
+    }
+
+def _inc_scores(user_id: str, scopes: Dict[str, Optional[int]], display_name: str, delta: int, game_key: Optional[str] = None) -> bool:
+    """
+    Adds delta to every scope for one user in a single transactional batch.
+    PK is /userId so all of a user's scope docs share a partition.
+    Assumes the docs exist (returning player); if a patch 404s or a create
+    409s the batch is rolled back, we re-check which docs exist and retry.
+    With a game_key the batch also creates that game's applied marker, so
+    the delta lands at most once per game. Returns False if it already had.
+    """
+    existing = set(scopes)
+    for attempt in range(SCORE_WRITE_RETRIES + 1):
+        ops = _score_batch_ops(user_id, scopes, display_name, delta, existing)
+        if game_key:
+            ops.append(("create", (_applied_marker(user_id, game_key),)))
+        try:
+            results = scores_container.execute_item_batch(batch_operations=ops, partition_key=user_id)
+            docs = [res.get("resourceBody") or {} for res in results]
+            _push_scores_to_redis([doc for doc in docs if "scope" in doc])
+            return True
+        except exceptions.CosmosBatchOperationError as e:
+            status = e.operation_responses[e.error_index].get("statusCode")
+            if game_key and e.error_index == len(ops) - 1 and status == 409:
+                return False
+            if status not in (404, 409) or attempt == SCORE_WRITE_RETRIES:
+                raise
+            existing = _existing_score_scopes(user_id, scopes)
+
+def _apply_score_deltas(deltas: Dict[str, int], display_names: Dict[str, str], game_key: Optional[str] = None) -> Dict[str, str]:
+    """
+    Applies {player_id: delta} across all score scopes, one batch per player,
+    with players written concurrently on player_executor.
+    Players the game_key was already applied to are left alone and count as done.
+    Returns {player_id: error} for players whose write failed.
+    """
+    scopes = _score_scopes()
+    futures = {
+        pid: player_executor.submit(_inc_scores, pid, scopes, display_names.get(pid, ""), delta, game_key)
+        for pid, delta in deltas.items()
+    }
+    failed = {}
+    already = 0
+    for pid, future in futures.items():
+        try:
+            if not future.result():
+                already += 1
+        except Exception as e:
+            logging.exception(f"score update failed for player_id={pid}")
+            failed[pid] = str(e)
+    if already:
+        logging.info(f"score deltas for game {game_key} were already applied to {already} players")
+    return failed
+
+# Finalization records make results exactly-once per game.
+# PK is /id, the game key from _game_identity (match code + lobby createdAt),
+# because codes are reused. Records expire via per-item ttl (the container
+# needs TTL enabled with no default).
+# A claim is a lease: if the worker holding it dies or some scores fail, the
+# record stays pending and the next call takes it over once the lease runs
+# out. Per-player applied markers (see _inc_scores) stop the takeover from
+# applying a player twice.
+# Completing also writes a copy under last:{match code}, so a retry after the
+# lobby is gone finds the outcome with one point read.
+FINALIZATION_TTL_SECONDS = int(os.environ.get("FINALIZATION_TTL_SECONDS", str(24 * 60 * 60)))
+FINALIZATION_LEASE_SECONDS = int(os.environ.get("FINALIZATION_LEASE_SECONDS", "120"))
+
+def _get_finalization(game_key: str) -> Optional[Dict[str, Any]]:
     try:
-        # PK is /userId
-        doc = scores_container.read_item(item=scope, partition_key=user_id)
+        return finalizations_container.read_item(item=game_key, partition_key=game_key)
     except exceptions.CosmosResourceNotFoundError:
-        doc = {
-            "id": scope,          # id is just the scope now
-            "userId": user_id,    
-            "scope": scope,
-            "score": 0,
-            "displayName": display_name,
-        }
+        return None
 
-    doc["score"] = int(doc.get("score", 0)) + int(delta)
-    doc["displayName"] = display_name
-    doc["updatedAt"] = now
+def _finalization_settled(record: Dict[str, Any]) -> bool:
+    """True if the record answers the call: completed, or claimed under a live lease."""
+    return record.get("status") == "completed" or record.get("leaseUntil", 0) > time.time()
 
-    scores_container.upsert_item(doc)
+def _claim_finalization(game_key: str, game_id: str, totals: Dict[str, int]) -> Optional[Dict[str, Any]]:
+    """
+    Claims the game's finalization. Returns None if this call now owns it,
+    otherwise the settled record to answer with. A pending record whose
+    lease has run out is taken over with an ETag-guarded replace.
+    """
+    claim = {
+        "id": game_key,
+        "gameId": game_id,
+        "status": "pending",
+        "totals": totals,
+        "claimedAt": _now_z(),
+        "leaseUntil": time.time() + FINALIZATION_LEASE_SECONDS,
+        "ttl": FINALIZATION_TTL_SECONDS,
+    }
+    for _ in range(2):
+        try:
+            finalizations_container.create_item(claim)
+            return None
+        except exceptions.CosmosResourceExistsError:
+            record = _get_finalization(game_key)
+        if record is None:
+            # Expired between the create and the read
+            continue
+        if _finalization_settled(record):
+            return record
+        try:
+            finalizations_container.replace_item(
+                item=game_key, body=claim, etag=record["_etag"], match_condition=MatchConditions.IfNotModified
+            )
+            logging.warning(f"took over stale finalization claim for game {game_key}")
+            return None
+        except exceptions.CosmosAccessConditionFailedError:
+            return _get_finalization(game_key) or record
+    return claim
+
+def _last_finalization_id(game_id: str) -> str:
+    return f"last:{game_id}"
+
+def _complete_finalization(game_key: str, game_id: str, totals: Dict[str, int], response: Dict[str, Any]) -> None:
+    record = {
+        "id": game_key,
+        "gameId": game_id,
+        "gameKey": game_key,
+        "status": "completed",
+        "totals": totals,
+        "response": response,
+        "completedAt": _now_z(),
+        "ttl": FINALIZATION_TTL_SECONDS,
+    }
+    finalizations_container.upsert_item(record)
+    finalizations_container.upsert_item({**record, "id": _last_finalization_id(game_id)})
+
+def _release_finalization(game_key: str, game_id: str, totals: Dict[str, int]) -> None:
+    # Drops the lease so the next call retries the players that failed
+    finalizations_container.upsert_item({
+        "id": game_key,
+        "gameId": game_id,
+        "status": "pending",
+        "totals": totals,
+        "leaseUntil": 0,
+        "ttl": FINALIZATION_TTL_SECONDS,
+    })
+
+def _finalization_response(record: Dict[str, Any]) -> func.HttpResponse:
+    if record.get("status") == "completed":
+        return _json(record["response"], 200)
+    game_id = record.get("gameId", record["id"])
+    return _json({"result": False, "msg": "Game finalization already in progress", "game_id": game_id}, 409)
+
+# ----- Guess queue sender -----
+GUESS_QUEUE_NAME = "guesses"
+GUESS_BATCH_MODE = os.environ.get("GUESS_BATCH_MODE", "0") == "1"
+GUESS_BATCH_MAX_MESSAGES = int(os.environ.get("GUESS_BATCH_MAX_MESSAGES", "50"))
+GUESS_BATCH_MAX_DELAY_MS = float(os.environ.get("GUESS_BATCH_MAX_DELAY_MS", "5"))
+GUESS_SENDER_MAX_IDLE_SECONDS = float(os.environ.get("GUESS_SENDER_MAX_IDLE_SECONDS", "240"))
+GUESS_SENDER_POOL_SIZE = int(os.environ.get("GUESS_SENDER_POOL_SIZE", "4"))
+GUESS_SEND_TIMEOUT_SECONDS = float(os.environ.get("GUESS_SEND_TIMEOUT_SECONDS", "10"))
+
+class _GuessLink:
+    """
+    One Service Bus client and queue sender, used by one thread at a time.
+    The link is rebuilt after a failed send or when it has sat idle long
+    enough that the service may have dropped it.
+    """
 
-def _enqueue_guess(game_id:str, player_id: str, lat: float, lon: float, round_no: int) -> None:
-    conn_str = os.environ["ServiceBusConnection"]
-    queue_name = "guesses"
+    def __init__(self, conn_str: str, queue_name: str):
+        self._conn_str = conn_str
+        self._queue_name = queue_name
+        self._client = None
+        self._sender = None
+        self._last_used = 0.0
+
+    def _get_sender(self):
+        if self._sender is not None and time.monotonic() - self._last_used > GUESS_SENDER_MAX_IDLE_SECONDS:
+            self.close()
+        if self._sender is None:
+            self._client = ServiceBusClient.from_connection_string(self._conn_str)
+            self._sender = self._client.get_queue_sender(self._queue_name)
+        return self._sender
+
+    def close(self) -> None:
+        for closable in (self._sender, self._client):
+            try:
+                if closable is not None:
+                    closable.close()
+            except Exception:
+                logging.warning("guess sender: error while closing", exc_info=True)
+        self._sender = None
+        self._client = None
+
+    def send_with_retry(self, send) -> None:
+        # One reconnect attempt covers a link the service has closed under us
+        for attempt in range(2):
+            try:
+                send(self._get_sender())
+                self._last_used = time.monotonic()
+                return
+            except Exception:
+                self.close()
+                if attempt == 1:
+                    raise
+                logging.warning("guess sender: send failed, reconnecting", exc_info=True)
+
+class _GuessSender:
+    """
+    A small pool of long-lived Service Bus links per worker instead of a new
+    AMQP connection per guess. Each send checks a link out, so up to
+    GUESS_SENDER_POOL_SIZE guesses are in flight at once. Links connect on
+    first use and the most recently used one is handed out first, so spare
+    links stay unopened at low traffic.
+
+    In batch mode callers hand messages to a flusher thread, which sends
+    everything queued within GUESS_BATCH_MAX_DELAY_MS (or
+    GUESS_BATCH_MAX_MESSAGES) as one ServiceBusMessageBatch. Callers still
+    block until their batch is sent, so a failure is reported to the request.
+
+    Every wait is bounded by GUESS_SEND_TIMEOUT_SECONDS, so a hung send fails
+    its requests instead of blocking the worker.
+    """
 
+    def __init__(self, conn_str: str, queue_name: str, pool_size: int = GUESS_SENDER_POOL_SIZE):
+        self._idle = [_GuessLink(conn_str, queue_name) for _ in range(pool_size)]
+        # Callers waiting for a link, oldest first. A returned link goes straight
+        # to the oldest one, so a busy caller can't keep grabbing it back.
+        self._waiters: "deque[Future]" = deque()
+        self._lock = threading.Lock()
+        self._pending: "queue.Queue[tuple[ServiceBusMessage, Future]]" = queue.Queue()
+        self._flusher = None
+
+    def _checkout(self) -> _GuessLink:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            waiter: Future = Future()
+            self._waiters.append(waiter)
+        try:
+            return waiter.result(timeout=GUESS_SEND_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise TimeoutError("No Service Bus sender free to queue the guess")
+            # Handed a link just as we gave up
+            return waiter.result()
+
+    def _checkin(self, link: _GuessLink) -> None:
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set_result(link)
+            else:
+                self._idle.append(link)
+
+    def _send_with_retry(self, send) -> None:
+        link = self._checkout()
+        try:
+            link.send_with_retry(send)
+        finally:
+            self._checkin(link)
+
+    def send(self, message: ServiceBusMessage) -> None:
+        if not GUESS_BATCH_MODE:
+            self._send_with_retry(lambda sender: sender.send_messages(message, timeout=GUESS_SEND_TIMEOUT_SECONDS))
+            return
+
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="guess-flusher", daemon=True)
+                    self._flusher.start()
+        done: Future = Future()
+        self._pending.put((message, done))
+        try:
+            done.result(timeout=GUESS_SEND_TIMEOUT_SECONDS + GUESS_BATCH_MAX_DELAY_MS / 1000)
+        except FutureTimeoutError:
+            raise TimeoutError("Timed out queueing the guess")
+
+    def _flush_loop(self) -> None:
+        while True:
+            items = [self._pending.get()]
+            deadline = time.monotonic() + GUESS_BATCH_MAX_DELAY_MS / 1000
+            while len(items) < GUESS_BATCH_MAX_MESSAGES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._send_with_retry(lambda sender: self._send_batches(sender, [m for m, _ in items]))
+            except Exception as e:
+                for _, done in items:
+                    done.set_exception(e)
+            else:
+                for _, done in items:
+                    done.set_result(None)
+
+    @staticmethod
+    def _send_batches(sender, messages: list) -> None:
+        batch = sender.create_message_batch()
+        for message in messages:
+            try:
+                batch.add_message(message)
+            except ValueError:
+                # Batch is at its size limit, send it and start another
+                sender.send_messages(batch, timeout=GUESS_SEND_TIMEOUT_SECONDS)
+                batch = sender.create_message_batch()
+                batch.add_message(message)
+        sender.send_messages(batch, timeout=GUESS_SEND_TIMEOUT_SECONDS)
+
+# Connects lazily on the first guess
+guess_sender = _GuessSender(os.environ.get("ServiceBusConnection"), GUESS_QUEUE_NAME)
+
+def _enqueue_guess(game_id:str, player_id: str, lat: float, lon: float, round_no: int) -> None:
     payload = {
         "game_id": game_id,
         "player_id": player_id,
@@ -116,14 +678,77 @@ def _enqueue_guess(game_id:str, player_id: str, lat: float, lon: float, round_no
         "round_no": round_no
     }
 
-    with ServiceBusClient.from_connection_string(conn_str) as client:
-        with client.get_queue_sender(queue_name) as sender:
-            sender.send_messages(
-                ServiceBusMessage(
-                    json.dumps(payload),
-                    content_type="application/json"
-                )
-            )
+    guess_sender.send(
+        ServiceBusMessage(
+            json.dumps(payload),
+            content_type="application/json"
+        )
+    )
+
+# ----- Direct guess ingestion -----
+# "queue": guess -> Service Bus -> process_guess_queue -> Redis (default)
+# "redis": guess is scored and stored in Redis by this request, and falls back
+#          to the queue if Redis can't be reached
+GUESS_INGESTION_MODE = os.environ.get("GUESS_INGESTION_MODE", "queue")
+# Must match SCORING_ENGINE in the durable app: "geo" stores raw guesses for
+# process_scores to rank with GEOSEARCH instead of scoring them here
+SCORING_ENGINE = os.environ.get("SCORING_ENGINE", "python")
+ROUND_KEY_TTL_SECONDS = 2 * 60 * 60
+
+# Same curves as SCORING_PROFILES in background_func_app
+SCORING_PROFILES = {
+    "city-strict": {"curve": "exp", "max_score": 5000, "scale_km": 0.25},
+    "city-forgiving": {"curve": "exp", "max_score": 5000, "scale_km": 0.5},
+    "linear": {"curve": "linear", "max_score": 5000, "scale_km": 1.0},
+    "region": {"curve": "exp", "max_score": 5000, "scale_km": 2.0},
+}
+DEFAULT_SCORING_PROFILE = "city-strict"
+
+# KEYS: answer key, round guesses hash. ARGV: player_id, lat, lon, profiles JSON, default profile
+# The answer's "profile" field picks the curve.
+# Returns the stored guess JSON, or nil if the round has no answer yet.
+SCORE_GUESS_LUA = """
+local ans = redis.call('GET', KEYS[1])
+if not ans then return nil end
+local a = cjson.decode(ans)
+local rad = math.pi / 180
+local lat1, lon1 = tonumber(ARGV[2]), tonumber(ARGV[3])
+local lat2, lon2 = tonumber(a.lat), tonumber(a.lon)
+local d_lat = (lat2 - lat1) * rad
+local d_lon = (lon2 - lon1) * rad
+local h = math.sin(d_lat / 2) ^ 2 + math.cos(lat1 * rad) * math.cos(lat2 * rad) * math.sin(d_lon / 2) ^ 2
+local dist = 6371 * 2 * math.atan2(math.sqrt(h), math.sqrt(1 - h))
+local profiles = cjson.decode(ARGV[4])
+local p = profiles[a.profile] or profiles[ARGV[5]]
+local raw
+if p.curve == 'linear' then
+    raw = p.max_score - dist / p.scale_km
+else
+    raw = p.max_score * math.exp(-dist / p.scale_km)
+end
+local score = math.max(0, math.min(p.max_score, math.floor(raw + 0.5)))
+local entry = cjson.encode({player_id = ARGV[1], dist_km = math.floor(dist * 100 + 0.5) / 100, score = score})
+redis.call('HSET', KEYS[2], ARGV[1], entry)
+return entry
+"""
+SCORING_PROFILES_JSON = json.dumps(SCORING_PROFILES)
+score_guess_script = r.register_script(SCORE_GUESS_LUA) if r else None
+
+def _record_guess_in_redis(game_id: str, player_id: str, lat: float, lon: float, round_no: int) -> Optional[Dict[str, Any]]:
+    """Scores and stores a guess in one Redis round trip. Returns None if the round has no answer."""
+    if SCORING_ENGINE == "geo":
+        geo_key = f"match:{game_id}:round:{round_no}:geo"
+        pipe = r.pipeline(transaction=False)
+        pipe.geoadd(geo_key, [lon, lat, player_id])
+        pipe.expire(geo_key, ROUND_KEY_TTL_SECONDS)
+        pipe.execute()
+        return {"player_id": player_id}
+
+    entry = score_guess_script(
+        keys=[f"match:{game_id}:round:{round_no}:answer", f"match:{game_id}:round_guesses"],
+        args=[player_id, lat, lon, SCORING_PROFILES_JSON, DEFAULT_SCORING_PROFILE],
+    )
+    return json.loads(entry) if entry else None
 
 @app.route(route="register", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
 def register(req: func.HttpRequest) -> func.HttpResponse:
@@ -132,17 +757,26 @@ def register(req: func.HttpRequest) -> func.HttpResponse:
         username = _norm_username(body["username"])
         password = body["password"]
 
-        if _get_user_by_username(username):
+        user_id = str(uuid.uuid4())
+        if not _reserve_username(username, user_id) and not _reclaim_orphaned_username(username, user_id):
             return _json({"result": False, "msg": "Username already exists"}, 409)
 
         user_doc = {
-            "id": str(uuid.uuid4()),
+            "id": user_id,
             "username": username,
             "displayName": username,
             "passwordHash": bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8"),
             "createdAt": _now_z(),
         }
-        users_container.create_item(user_doc)
+        try:
+            users_container.create_item(user_doc)
+        except Exception:
+            # Release the name so the user can retry. A lookup may have cached
+            # the name -> id mapping in the meantime, so drop it too.
+            usernames_container.delete_item(item=username, partition_key=username)
+            _invalidate_user(user_id, username)
+            raise
+        _invalidate_user(user_id, username)
         return _json({"result": True, "msg": "OK"}, 201)
 
     except Exception as e:
@@ -171,6 +805,35 @@ def login(req: func.HttpRequest) -> func.HttpResponse:
 
 
 
+# Migration: builds the username index for users created before it existed.
+# Lookups also index a missing user on first use, so this just saves those
+# users a slow first login. Safe to re-run, existing index entries are left alone.
+@app.route(route="backfill_username_index", auth_level=func.AuthLevel.ADMIN, methods=["POST"])
+def backfill_username_index(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        created = 0
+        existing = 0
+        conflicts = []
+        query = "SELECT c.id, c.username FROM c WHERE IS_DEFINED(c.username)"
+        for user in users_container.query_items(query=query, enable_cross_partition_query=True):
+            username = _norm_username(user["username"])
+            if _reserve_username(username, user["id"]):
+                created += 1
+                continue
+
+            entry = usernames_container.read_item(item=username, partition_key=username)
+            if entry["userId"] == user["id"]:
+                existing += 1
+            else:
+                conflicts.append({"username": username, "userId": user["id"], "indexedUserId": entry["userId"]})
+
+        return _json({"result": True, "msg": "OK", "created": created, "existing": existing, "conflicts": conflicts})
+
+    except Exception as e:
+        logging.exception("backfill_username_index failed")
+        return _json({"result": False, "msg": str(e)}, 500)
+
+
 @app.route(route="add_score", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
 def add_score(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -196,8 +859,8 @@ def add_score(req: func.HttpRequest) -> func.HttpResponse:
         user_id = user["id"]
         display_name = user.get("displayName", username)
 
-        _inc_score(user_id, "alltime", display_name, delta)
-        _inc_score(user_id, _month_scope(), display_name, delta)
+        _inc_scores(user_id, _score_scopes(), display_name, delta)
+        logging.info(f"add_score: user cache stats={_user_cache_stats()}")
 
         return _json({"result": True, "msg": "OK"})
 
@@ -207,6 +870,261 @@ def add_score(req: func.HttpRequest) -> func.HttpResponse:
 
 
 
+# ----- Leaderboard snapshot -----
+# One precomputed top-N doc per scope, kept in the leaderboard container
+# (pk = /scope) next to the per-user rows. Scores only ever go up, so
+# insert / reposition / evict on each change keeps it exact.
+LEADERBOARD_TOP_N = 100
+SNAPSHOT_ID = "_top"
+SNAPSHOT_RETRIES = 5
+
+def _leaderboard_entry(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "userId": row["userId"],
+        "displayName": row.get("displayName", ""),
+        "score": int(row.get("score", 0)),
+        "updatedAt": row.get("updatedAt"),
+    }
+
+def _query_top(scope: str, limit: int) -> list:
+    query = f"""
+    SELECT TOP {limit} c.userId, c.displayName, c.score, c.updatedAt
+    FROM c
+    WHERE c.scope = @s AND IS_DEFINED(c.userId)
+    ORDER BY c.score DESC
+    """
+    params = [{"name": "@s", "value": scope}]
+    return list(leaderboard_container.query_items(
+        query=query,
+        parameters=params,
+        partition_key=scope
+    ))
+
+def _read_snapshot(scope: str) -> Optional[Dict[str, Any]]:
+    try:
+        return leaderboard_container.read_item(item=SNAPSHOT_ID, partition_key=scope)
+    except exceptions.CosmosResourceNotFoundError:
+        return None
+
+def _merge_into_top(top: list, rows: list) -> list:
+    by_user = {e["userId"]: e for e in top}
+    for row in rows:
+        by_user[row["userId"]] = _leaderboard_entry(row)
+    merged = sorted(by_user.values(), key=lambda e: e["score"], reverse=True)
+    return merged[:LEADERBOARD_TOP_N]
+
+def _update_snapshot(scope: str, rows: list) -> None:
+    """
+    Folds changed leaderboard rows into the scope's top-N doc.
+    Uses the doc's ETag so concurrent change-feed workers don't clobber each other.
+    """
+    for _ in range(SNAPSHOT_RETRIES):
+        snapshot = _read_snapshot(scope)
+        try:
+            if snapshot is None:
+                # First write for this scope: seed from the projected rows
+                top = _merge_into_top(_query_top(scope, LEADERBOARD_TOP_N), rows)
+                leaderboard_container.create_item({"id": SNAPSHOT_ID, "scope": scope, "top": top, "updatedAt": _now_z()})
+            else:
+                threshold = snapshot["top"][-1]["score"] if len(snapshot["top"]) >= LEADERBOARD_TOP_N else None
+                members = {e["userId"] for e in snapshot["top"]}
+                if threshold is not None and not any(row["userId"] in members or row["score"] > threshold for row in rows):
+                    return
+                snapshot["top"] = _merge_into_top(snapshot["top"], rows)
+                snapshot["updatedAt"] = _now_z()
+                leaderboard_container.replace_item(
+                    item=SNAPSHOT_ID,
+                    body=snapshot,
+                    etag=snapshot["_etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            return
+        except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError):
+            continue
+    raise RuntimeError(f"leaderboard snapshot for scope={scope} kept conflicting")
+
+
+# ----- Rank histogram -----
+# Per scope count of players in fixed-width score buckets, so a rank is a sum
+# over buckets plus one count inside the player's own bucket.
+RANK_BUCKET_WIDTH = int(os.environ.get("RANK_BUCKET_WIDTH", "1000"))
+HISTOGRAM_ID = "_hist"
+
+def _bucket(score: int) -> str:
+    return str(int(score) // RANK_BUCKET_WIDTH)
+
+def _previous_scores(scope: str, user_ids: list) -> Dict[str, int]:
+    query = "SELECT c.userId, c.score FROM c WHERE ARRAY_CONTAINS(@ids, c.userId)"
+    params = [{"name": "@ids", "value": user_ids}]
+    rows = leaderboard_container.query_items(query=query, parameters=params, partition_key=scope)
+    return {row["userId"]: int(row.get("score", 0)) for row in rows}
+
+def _seed_histogram(scope: str) -> Dict[str, int]:
+    query = """
+    SELECT FLOOR(c.score / @w) AS b, COUNT(1) AS n
+    FROM c
+    WHERE IS_DEFINED(c.userId)
+    GROUP BY FLOOR(c.score / @w)
+    """
+    params = [{"name": "@w", "value": RANK_BUCKET_WIDTH}]
+    rows = leaderboard_container.query_items(query=query, parameters=params, partition_key=scope)
+    return {str(int(row["b"])): int(row["n"]) for row in rows}
+
+def _update_histogram(scope: str, moves: list) -> None:
+    """
+    Applies (old_score | None, new_score) moves to the scope histogram.
+    Call after the rows are written, the first call seeds from them instead.
+    """
+    for _ in range(SNAPSHOT_RETRIES):
+        try:
+            hist = leaderboard_container.read_item(item=HISTOGRAM_ID, partition_key=scope)
+        except exceptions.CosmosResourceNotFoundError:
+            hist = None
+        try:
+            if hist is None:
+                leaderboard_container.create_item({
+                    "id": HISTOGRAM_ID,
+                    "scope": scope,
+                    "width": RANK_BUCKET_WIDTH,
+                    "buckets": _seed_histogram(scope),
+                    "updatedAt": _now_z(),
+                })
+                return
+
+            buckets = hist["buckets"]
+            for old, new in moves:
+                if old is not None:
+                    b = _bucket(old)
+                    buckets[b] = buckets.get(b, 0) - 1
+                    if buckets[b] <= 0:
+                        del buckets[b]
+                b = _bucket(new)
+                buckets[b] = buckets.get(b, 0) + 1
+            hist["updatedAt"] = _now_z()
+            leaderboard_container.replace_item(
+                item=HISTOGRAM_ID,
+                body=hist,
+                etag=hist["_etag"],
+                match_condition=MatchConditions.IfNotModified,
+            )
+            return
+        except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError):
+            continue
+    raise RuntimeError(f"rank histogram for scope={scope} kept conflicting")
+
+
+# ----- Redis leaderboard tier -----
+# leaderboard:{scope}          ZSET  member userId, score = total points
+# leaderboard:{scope}:players  HASH  userId -> JSON {displayName, updatedAt}
+# leaderboard:{scope}:version  counter bumped whenever a score moves, used as the ETag
+# leaderboard:{scope}:ready    set once the ZSET holds every Cosmos row
+# leaderboard:{scope}:rebuilding  held by the worker rebuilding the scope
+# Cosmos stays the source of truth. Scores only go up, so a keep-the-max
+# write makes updates from the change feed and the score path order-independent.
+def _lb_key(scope: str) -> str:
+    return f"leaderboard:{scope}"
+
+# KEYS: zset, version. ARGV: member, score
+# ZADD GT needs Redis 6.2, Azure Cache for Redis runs 6.0, so the max is kept here.
+# Returns 1 if the score moved.
+ZADD_MAX_LUA = """
+local current = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if current and tonumber(current) >= tonumber(ARGV[2]) then return 0 end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('INCR', KEYS[2])
+return 1
+"""
+zadd_max_script = r.register_script(ZADD_MAX_LUA) if r else None
+
+def _write_scores_to_redis(rows: list) -> None:
+    pipe = r.pipeline(transaction=False)
+    for row in rows:
+        key = _lb_key(row["scope"])
+        zadd_max_script(keys=[key, f"{key}:version"], args=[row["userId"], int(row.get("score", 0))], client=pipe)
+        pipe.hset(f"{key}:players", row["userId"], json.dumps({
+            "displayName": row.get("displayName", ""),
+            "updatedAt": row.get("updatedAt"),
+        }))
+        if row.get("ttl"):
+            for k in (key, f"{key}:players", f"{key}:version", f"{key}:ready"):
+                pipe.expire(k, row["ttl"])
+    pipe.execute()
+
+def _push_scores_to_redis(rows: list) -> None:
+    # Best effort, the change feed and rebuild will catch Redis up
+    if r is None or not rows:
+        return
+    try:
+        _write_scores_to_redis(rows)
+    except Exception:
+        logging.exception("failed to push scores to Redis")
+
+def _rebuild_redis_leaderboard(scope: str) -> int:
+    """Repopulates a scope's Redis tier from the Cosmos leaderboard rows."""
+    # Restart the version from the clock so ETags from before a flush can't match again
+    r.set(f"{_lb_key(scope)}:version", int(time.time() * 1000))
+    query = "SELECT c.userId, c.scope, c.displayName, c.score, c.updatedAt, c.ttl FROM c WHERE IS_DEFINED(c.userId)"
+    count = 0
+    batch = []
+    ttl = None
+    for row in leaderboard_container.query_items(query=query, partition_key=scope):
+        ttl = row.get("ttl") or ttl
+        batch.append(row)
+        if len(batch) >= 500:
+            _write_scores_to_redis(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _write_scores_to_redis(batch)
+        count += len(batch)
+    r.set(f"{_lb_key(scope)}:ready", _now_z(), ex=ttl)
+    return count
+
+# Upper bound on a rebuild; the lock is deleted as soon as it finishes
+LEADERBOARD_REBUILD_LOCK_SECONDS = int(os.environ.get("LEADERBOARD_REBUILD_LOCK_SECONDS", "600"))
+
+def _locked_rebuild(scope: str, only_if_missing: bool = False) -> Optional[int]:
+    """Rebuilds a scope unless another worker is already. Returns the row count, or None if skipped."""
+    key = _lb_key(scope)
+    if only_if_missing and r.exists(f"{key}:ready"):
+        return None
+    if not r.set(f"{key}:rebuilding", "1", nx=True, ex=LEADERBOARD_REBUILD_LOCK_SECONDS):
+        return None
+    try:
+        return _rebuild_redis_leaderboard(scope)
+    finally:
+        r.delete(f"{key}:rebuilding")
+
+def _redis_leaderboard_ready(scope: str) -> bool:
+    """
+    True if reads for this scope can be served from Redis. After a flush reads
+    go to Cosmos until rebuild_missing_leaderboards (or the admin route) has
+    refilled the scope; requests never rebuild inline.
+    """
+    if r is None:
+        return False
+    try:
+        return bool(r.exists(f"{_lb_key(scope)}:ready"))
+    except Exception:
+        logging.exception(f"Redis leaderboard unavailable for scope={scope}")
+    return False
+
+def _redis_entries(scope: str, members: list) -> list:
+    if not members:
+        return []
+    infos = r.hmget(f"{_lb_key(scope)}:players", [user_id for user_id, _ in members])
+    entries = []
+    for (user_id, score), info in zip(members, infos):
+        info = json.loads(info) if info else {}
+        entries.append({
+            "userId": user_id,
+            "displayName": info.get("displayName", ""),
+            "score": int(score),
+            "updatedAt": info.get("updatedAt"),
+        })
+    return entries
+
+
 @app.route(route="leaderboard", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
 def leaderboard(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -215,30 +1133,196 @@ def leaderboard(req: func.HttpRequest) -> func.HttpResponse:
     GET /leaderboard?scope=month:2025-12&limit=10
     """
     try:
-        scope = req.params.get("scope") or "alltime"
+        scope = _resolve_scope(req.params.get("scope") or "alltime")
         limit = int(req.params.get("limit") or "10")
-        limit = max(1, min(limit, 100))
+        limit = max(1, min(limit, LEADERBOARD_TOP_N))
+
+        if _redis_leaderboard_ready(scope):
+            pipe = r.pipeline(transaction=False)
+            pipe.get(f"{_lb_key(scope)}:version")
+            pipe.zrevrange(_lb_key(scope), 0, limit - 1, withscores=True)
+            version, members = pipe.execute()
+            etag = f'"r{version or 0}-{limit}"'
+            if req.headers.get("If-None-Match") == etag:
+                return func.HttpResponse(status_code=304, headers={"ETag": etag})
+            return _json({"result": True, "scope": scope, "top": _redis_entries(scope, members)}, headers={"ETag": etag})
+
+        snapshot = _read_snapshot(scope)
+        if snapshot is None:
+            # Nothing projected for this scope yet
+            return _json({"result": True, "scope": scope, "top": _query_top(scope, limit)})
+
+        # Quoted (and limit-specific) so polling clients can send it back as If-None-Match
+        version = snapshot["_etag"].strip('"')
+        etag = f'"{version}-{limit}"'
+        if req.headers.get("If-None-Match") == etag:
+            return func.HttpResponse(status_code=304, headers={"ETag": etag})
+
+        return _json({"result": True, "scope": scope, "top": snapshot["top"][:limit]}, headers={"ETag": etag})
 
-        query = f"""
-        SELECT TOP {limit} c.userId, c.displayName, c.score, c.updatedAt
-        FROM c
-        WHERE c.scope = @s
-        ORDER BY c.score DESC
-        """
-        params = [{"name": "@s", "value": scope}]
+    except Exception as e:
+        logging.exception("leaderboard failed")
+        return _json({"result": False, "msg": str(e)}, 500)
 
-        items = list(leaderboard_container.query_items(
-            query=query,
-            parameters=params,
-            enable_cross_partition_query=False
-        ))
+@app.route(route="rank", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
+def rank(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Player's rank within a scope plus the players either side of them
+    GET /rank?userId=<id>&scope=alltime&around=5
+    """
+    try:
+        user_id = req.params.get("userId")
+        if not user_id:
+            return _json({"result": False, "msg": "Missing param: userId"}, 400)
+        scope = _resolve_scope(req.params.get("scope") or "alltime")
+        around = int(req.params.get("around") or "5")
+        around = max(0, min(around, 25))
+
+        if _redis_leaderboard_ready(scope):
+            key = _lb_key(scope)
+            score = r.zscore(key, user_id)
+            if score is None:
+                return _json({"result": False, "msg": "Player has no score in this scope"}, 404)
+            pos = r.zrevrank(key, user_id)
+            start = max(0, pos - around)
+            pipe = r.pipeline(transaction=False)
+            pipe.zcount(key, f"({score}", "+inf")
+            pipe.zcard(key)
+            pipe.zrevrange(key, start, pos + around, withscores=True)
+            above, total, window = pipe.execute()
+            return _json({
+                "result": True,
+                "scope": scope,
+                "rank": above + 1,
+                "total": total,
+                "player": _redis_entries(scope, [(user_id, score)])[0],
+                "neighbours": {
+                    "above": _redis_entries(scope, window[:pos - start]),
+                    "below": _redis_entries(scope, window[pos - start + 1:]),
+                },
+            })
 
-        return _json({"result": True, "scope": scope, "top": items})
+        try:
+            row = leaderboard_container.read_item(item=user_id, partition_key=scope)
+        except exceptions.CosmosResourceNotFoundError:
+            return _json({"result": False, "msg": "Player has no score in this scope"}, 404)
+        score = int(row.get("score", 0))
+
+        try:
+            hist = leaderboard_container.read_item(item=HISTOGRAM_ID, partition_key=scope)
+            buckets = hist["buckets"]
+        except exceptions.CosmosResourceNotFoundError:
+            buckets = _seed_histogram(scope)
+
+        # Everyone in a higher bucket, plus whoever beats us inside our own bucket
+        own = int(_bucket(score))
+        above = sum(n for b, n in buckets.items() if int(b) > own)
+        query = "SELECT VALUE COUNT(1) FROM c WHERE IS_DEFINED(c.userId) AND c.score > @score AND c.score < @hi"
+        params = [{"name": "@score", "value": score}, {"name": "@hi", "value": (own + 1) * RANK_BUCKET_WIDTH}]
+        above += list(leaderboard_container.query_items(query=query, parameters=params, partition_key=scope))[0]
+
+        neighbours = {"above": [], "below": []}
+        if around:
+            fields = "c.userId, c.displayName, c.score, c.updatedAt"
+            higher = list(leaderboard_container.query_items(
+                query=f"SELECT TOP {around} {fields} FROM c WHERE IS_DEFINED(c.userId) AND c.score > @score ORDER BY c.score ASC",
+                parameters=[{"name": "@score", "value": score}],
+                partition_key=scope,
+            ))
+            neighbours["above"] = list(reversed(higher))
+            neighbours["below"] = list(leaderboard_container.query_items(
+                query=f"SELECT TOP {around} {fields} FROM c WHERE IS_DEFINED(c.userId) AND c.score <= @score AND c.userId != @u ORDER BY c.score DESC",
+                parameters=[{"name": "@score", "value": score}, {"name": "@u", "value": user_id}],
+                partition_key=scope,
+            ))
+
+        return _json({
+            "result": True,
+            "scope": scope,
+            "rank": above + 1,
+            "total": sum(buckets.values()),
+            "player": _leaderboard_entry(row),
+            "neighbours": neighbours,
+        })
 
     except Exception as e:
-        logging.exception("leaderboard failed")
+        logging.exception("rank failed")
+        return _json({"result": False, "msg": str(e)}, 500)
+
+# Repopulates the Redis leaderboard tier from Cosmos, e.g. after a cache flush.
+# POST /rebuild_leaderboard_cache?scope=month:2025-12, or every scope if omitted.
+@app.route(route="rebuild_leaderboard_cache", auth_level=func.AuthLevel.ADMIN, methods=["POST"])
+def rebuild_leaderboard_cache(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        if r is None:
+            return _json({"result": False, "msg": "Redis not configured"}, 503)
+
+        scope = req.params.get("scope")
+        if scope:
+            scopes = [scope]
+        else:
+            scopes = list(leaderboard_container.query_items(
+                query="SELECT DISTINCT VALUE c.scope FROM c",
+                enable_cross_partition_query=True
+            ))
+
+        rebuilt = {}
+        busy = []
+        for s in scopes:
+            count = _locked_rebuild(s)
+            if count is None:
+                busy.append(s)
+            else:
+                rebuilt[s] = count
+        return _json({"result": True, "msg": "OK", "rebuilt": rebuilt, "alreadyRebuilding": busy})
+
+    except Exception as e:
+        logging.exception("rebuild_leaderboard_cache failed")
         return _json({"result": False, "msg": str(e)}, 500)
 
+# Refills the Redis tier for the current scopes after a flush, outside any
+# request. Scopes that have ended are only rebuilt through the admin route.
+@app.timer_trigger(schedule="0 */1 * * * *", arg_name="timer", run_on_startup=True)
+def rebuild_missing_leaderboards(timer: func.TimerRequest) -> None:
+    if r is None:
+        return
+    for scope in _score_scopes():
+        try:
+            count = _locked_rebuild(scope, only_if_missing=True)
+            if count is not None:
+                logging.warning(f"rebuilt Redis leaderboard for scope={scope} with {count} rows")
+        except Exception:
+            logging.exception(f"Redis leaderboard rebuild failed for scope={scope}")
+
+# Transactional batches are capped at 100 operations
+LEADERBOARD_BATCH_SIZE = 100
+
+def _write_leaderboard_rows(scope: str, rows: list) -> list:
+    """
+    Upserts rows for one scope partition in transactional batches, falling back
+    to single upserts if a batch is rejected. Returns the rows that were written.
+    """
+    written = []
+    for i in range(0, len(rows), LEADERBOARD_BATCH_SIZE):
+        chunk = rows[i:i + LEADERBOARD_BATCH_SIZE]
+        try:
+            leaderboard_container.execute_item_batch(
+                batch_operations=[("upsert", (row,)) for row in chunk],
+                partition_key=scope,
+            )
+            written.extend(chunk)
+            continue
+        except Exception:
+            logging.exception(f"leaderboard batch failed for scope={scope}, retrying rows singly")
+
+        for row in chunk:
+            try:
+                leaderboard_container.upsert_item(row)
+                written.append(row)
+            except Exception:
+                logging.exception("projection failed")
+    return written
+
 # Updates leaderboard automatically when score updates are made
 @app.function_name(name="scores_to_leaderboard")
 @app.cosmos_db_trigger(
@@ -251,16 +1335,26 @@ def leaderboard(req: func.HttpRequest) -> func.HttpResponse:
 )
 def scores_to_leaderboard(documents: func.DocumentList) -> None:
     """
-    For each changed score doc, upsert leaderboard row:
+    Collapses the batch to the latest score doc per (scope, userId) and
+    upserts a leaderboard row for each, batched per scope partition:
       leaderboard pk = /scope
       leaderboard id = userId
+    then folds the batch into each scope's top-N snapshot and rank histogram.
     """
     if not documents:
         return
 
+    # Keep only the newest version of each (scope, userId) in the batch
+    latest = {}
+    ignored = 0
+    parse_failed = 0
     for d in documents:
+        doc = dict(d)
+        if doc.get("type") == "applied":
+            # results' per-game applied markers share the container
+            ignored += 1
+            continue
         try:
-            doc = dict(d)
             lb = {
                 "id": doc["userId"],
                 "scope": doc["scope"],
@@ -269,9 +1363,76 @@ def scores_to_leaderboard(documents: func.DocumentList) -> None:
                 "score": int(doc.get("score", 0)),
                 "updatedAt": doc.get("updatedAt", _now_z()),
             }
-            leaderboard_container.upsert_item(lb)
+            if doc.get("ttl"):
+                lb["ttl"] = doc["ttl"]
         except Exception:
             logging.exception("projection failed")
+            parse_failed += 1
+            continue
+        key = (lb["scope"], lb["userId"])
+        current = latest.get(key)
+        if current is None or (lb["updatedAt"], lb["score"]) >= (current["updatedAt"], current["score"]):
+            latest[key] = lb
+
+    by_scope = {}  # scope -> projected rows
+    for (scope, _), lb in latest.items():
+        by_scope.setdefault(scope, []).append(lb)
+
+    written = 0
+    write_failed = 0
+    changed = {}
+    for scope, rows in by_scope.items():
+        try:
+            previous = _previous_scores(scope, [row["userId"] for row in rows])
+        except Exception:
+            logging.exception(f"could not read previous scores for scope={scope}")
+            previous = None
+
+        ok = _write_leaderboard_rows(scope, rows)
+        _push_scores_to_redis(ok)
+        written += len(ok)
+        write_failed += len(rows) - len(ok)
+        if ok:
+            changed[scope] = ok
+
+        if ok and previous is not None:
+            try:
+                _update_histogram(scope, [(previous.get(row["userId"]), row["score"]) for row in ok])
+            except Exception:
+                logging.exception(f"histogram update failed for scope={scope}")
+
+    # Every received doc is exactly one of: ignored, unparseable, folded into a newer one, or projected
+    coalesced = len(documents) - ignored - parse_failed - len(latest)
+    logging.info(
+        f"scores_to_leaderboard: received={len(documents)} ignored={ignored} parse_failed={parse_failed} "
+        f"coalesced={coalesced} written={written} write_failed={write_failed}"
+    )
+
+    for scope, rows in changed.items():
+        try:
+            _update_snapshot(scope, rows)
+        except Exception:
+            logging.exception(f"snapshot update failed for scope={scope}")
+
+
+# Place index read by prepare_match in the durable app (see _draw_places there)
+PLACE_IDS_KEY = "places:ids"
+PLACE_META_KEY = "places:meta"
+
+def _index_place(place_doc: Dict[str, Any]) -> None:
+    if r is None:
+        return
+    try:
+        # Always written, even while the index is missing or being rebuilt:
+        # both writes are idempotent, and completeness is tracked by
+        # places:ready, which only prepare_match's rebuild sets
+        compact = {k: place_doc[k] for k in ("id", "location", "blob")}
+        pipe = r.pipeline(transaction=False)
+        pipe.sadd(PLACE_IDS_KEY, place_doc["id"])
+        pipe.hset(PLACE_META_KEY, place_doc["id"], json.dumps(compact))
+        pipe.execute()
+    except Exception:
+        logging.exception("create_place: failed to add place to Redis index")
 
 
 @app.route(route="create_place", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
@@ -357,6 +1518,7 @@ def create_place(req: func.HttpRequest) -> func.HttpResponse:
 
         places_container = db.get_container_client(os.environ.get("COSMOS_PLACES_CONTAINER", "places"))
         places_container.create_item(place_doc)
+        _index_place(place_doc)
 
         return _json({"result": True, "msg": "OK", "placeId": place_id, "blobUrl": blob_url}, 201)
 
@@ -365,26 +1527,64 @@ def create_place(req: func.HttpRequest) -> func.HttpResponse:
         return _json({"result": False, "msg": str(e)}, 500)
     
 
-def _storage_account_name_and_key() -> tuple[str, str]:
-    # Parses "DefaultEndpointsProtocol=...;AccountName=...;AccountKey=...;EndpointSuffix=..."
-    parts = dict(
-        item.split("=", 1) for item in AZURE_STORAGE_CONNECTION_STRING.split(";") if "=" in item
-    )
-    return parts["AccountName"], parts["AccountKey"]
+# ----- Blob SAS signing -----
+SAS_TTL_MINUTES = int(os.environ.get("SAS_TTL_MINUTES", "30"))
+SAS_CACHE_SIZE = int(os.environ.get("SAS_CACHE_SIZE", "5000"))
+
+class _SasSigner:
+    """
+    Signs read-only blob URLs. The connection string is parsed once, and each
+    URL is reused until it gets close to its expiry, so a warm worker only
+    signs a given image every SAS_TTL_MINUTES.
+    """
+
+    def __init__(self, connection_string: str, ttl_minutes: int, max_size: int):
+        # Parses "DefaultEndpointsProtocol=...;AccountName=...;AccountKey=...;EndpointSuffix=..."
+        parts = dict(
+            item.split("=", 1) for item in connection_string.split(";") if "=" in item
+        )
+        self.account_name = parts["AccountName"]
+        self.account_key = parts["AccountKey"]
+        self.endpoint_suffix = parts.get("EndpointSuffix", "core.windows.net")
+        self.ttl = timedelta(minutes=ttl_minutes)
+        self.max_size = max_size
+        self._urls: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+
+    def url(self, container: str, blob_name: str, min_valid: timedelta) -> str:
+        """Returns a URL that stays valid for at least min_valid."""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        key = (container, blob_name)
+        with self._lock:
+            cached = self._urls.get(key)
+        if cached and cached[0] - now >= min_valid:
+            return cached[1]
+
+        expiry = now + max(self.ttl, min_valid)
+        sas = generate_blob_sas(
+            account_name=self.account_name,
+            container_name=container,
+            blob_name=blob_name,
+            account_key=self.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=expiry
+        )
+        url = f"https://{self.account_name}.blob.{self.endpoint_suffix}/{container}/{blob_name}?{sas}"
+
+        with self._lock:
+            self._urls.pop(key, None)
+            self._urls[key] = (expiry, url)
+            while len(self._urls) > self.max_size:
+                self._urls.pop(next(iter(self._urls)))
+        return url
+
+sas_signer = _SasSigner(AZURE_STORAGE_CONNECTION_STRING, SAS_TTL_MINUTES, SAS_CACHE_SIZE)
 
 def _blob_url_with_sas(container: str, blob_name: str, minutes: int = 5) -> str:
-    account_name, account_key = _storage_account_name_and_key()
-
-    sas = generate_blob_sas(
-        account_name=account_name,
-        container_name=container,
-        blob_name=blob_name,
-        account_key=account_key,
-        permission=BlobSasPermissions(read=True),
-        expiry=datetime.datetime.now(datetime.timezone.utc) + timedelta(minutes=minutes)
-    )
+    return sas_signer.url(container, blob_name, timedelta(minutes=minutes))
 
-    return f"https://{account_name}.blob.core.windows.net/{container}/{blob_name}?{sas}"
+# Places never change once created, so get_place can skip Cosmos on a warm worker
+place_cache = _TTLCache(int(os.environ.get("PLACE_CACHE_SIZE", "2000")), 60 * 60)
 
     
 @app.route(route="get_place", auth_level=func.AuthLevel.FUNCTION, methods=["GET"])
@@ -403,18 +1603,22 @@ def get_place(req: func.HttpRequest) -> func.HttpResponse:
         if not place_id:
             return _json({"result": False, "msg": "Missing param: id"}, 400)
 
-        # Parameterised query
-        query = "SELECT TOP 1 * FROM p WHERE p.id = @id"
-        params = [{"name": "@id", "value": place_id}]
-        items = list(places_container.query_items(
-            query=query,
-            parameters=params,
-            enable_cross_partition_query=True
-        ))
-        if not items:
-            return _json({"result": False, "msg": "Place not found"}, 404)
+        cached = place_cache.get(place_id)
+        if cached is None:
+            # Parameterised query
+            query = "SELECT TOP 1 * FROM p WHERE p.id = @id"
+            params = [{"name": "@id", "value": place_id}]
+            items = list(places_container.query_items(
+                query=query,
+                parameters=params,
+                enable_cross_partition_query=True
+            ))
+            if not items:
+                return _json({"result": False, "msg": "Place not found"}, 404)
+            cached = items[0]
+            place_cache.set(place_id, cached)
 
-        place = items[0]
+        place = {**cached, "blob": dict(cached["blob"])}
 
         container = place["blob"]["container"]
         blob_name = place["blob"]["name"]
@@ -428,53 +1632,479 @@ def get_place(req: func.HttpRequest) -> func.HttpResponse:
         return _json({"result": False, "msg": str(e)}, 500)
 
 
+# ----- Match store -----
+# Match docs use id == matchId with /matchId as the partition key, so every
+# lobby operation is a point read and a code is reserved by a conditional create.
+MATCH_CODE_ATTEMPTS = 20
+
+def _get_match(match_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        return matches_container.read_item(item=match_id, partition_key=match_id)
+    except exceptions.CosmosResourceNotFoundError:
+        return None
+
+LOBBY_UPDATE_RETRIES = 8
+
+class _LobbyConflict(Exception):
+    """Raised by a lobby mutation to abort with an HTTP error."""
+
+    def __init__(self, msg: str, status: int):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+def _update_match(match_id: str, mutate) -> Optional[Dict[str, Any]]:
+    """
+    Read-modify-write of a match doc guarded by If-Match on its ETag.
+    mutate(doc) edits the doc in place and returns "delete" to remove it,
+    or raises _LobbyConflict. On a lost race it re-reads and re-applies,
+    with jittered backoff, giving up with a 503. Returns the written doc,
+    or None if not found.
+    """
+    for attempt in range(LOBBY_UPDATE_RETRIES):
+        item = _get_match(match_id)
+        if item is None:
+            return None
+        action = mutate(item)
+        try:
+            if action == "delete":
+                matches_container.delete_item(
+                    item, partition_key=match_id, etag=item["_etag"], match_condition=MatchConditions.IfNotModified
+                )
+            else:
+                matches_container.replace_item(
+                    item=match_id, body=item, etag=item["_etag"], match_condition=MatchConditions.IfNotModified
+                )
+            return item
+        except exceptions.CosmosAccessConditionFailedError:
+            time.sleep(random.uniform(0, 0.01 * (2 ** attempt)))
+    raise _LobbyConflict("Lobby is busy, try again", 503)
+
+def _reserve_match_code(doc: Dict[str, Any]) -> str:
+    """Creates the match under a fresh random 6 digit code, retrying on a clash."""
+    for _ in range(MATCH_CODE_ATTEMPTS):
+        # generate 6 character match code
+        match_id = f"{random.randint(0, 999999):06d}"
+        try:
+            matches_container.create_item({**doc, "id": match_id, "matchId": match_id})
+            return match_id
+        except exceptions.CosmosResourceExistsError:
+            continue
+    raise RuntimeError("Could not allocate a free match code")
+
+LOBBY_MAX_PLAYERS_INVALID = "Lobby's maxPlayers setting is invalid"
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _cosmos_join(match_id: str, player_id: str) -> bool:
+    def add_player(item):
+        players = item.get("players", [])
+        max_players = item.get("matchSettings", {}).get("maxPlayers")
+
+        player_in_lobby = any(player["userId"] == player_id for player in players)
+        max_players_invalid = max_players is not None and not _is_number(max_players)
+        lobby_count_exceeded = max_players is not None and not max_players_invalid and len(players) >= max_players
+
+        if (player_in_lobby):
+            raise _LobbyConflict("Player already in lobby", 409)
+        elif (max_players_invalid):
+            raise _LobbyConflict(LOBBY_MAX_PLAYERS_INVALID, 409)
+        elif (lobby_count_exceeded):
+            raise _LobbyConflict("Lobby is full", 409)
+        item["players"] = players + [{"userId": player_id}]
+
+    return _update_match(match_id, add_player) is not None
+
+def _cosmos_quit(match_id: str, player_id: str) -> Optional[bool]:
+    closed = False
+
+    def remove_player(item):
+        nonlocal closed
+        players = item["players"]
+
+        player_in_lobby = any(player["userId"] == player_id for player in players)
+        lobby_empty = len(players) <= 1
+        closed = False
+
+        if (not player_in_lobby):
+            raise _LobbyConflict("Player isn't in lobby", 400)
+        elif (lobby_empty):
+            closed = True
+            return "delete"
+        item["players"] = [player for player in players if player["userId"] != player_id]
+
+    if _update_match(match_id, remove_player) is None:
+        return None
+    return closed
+
+def _cosmos_settings(match_id: str, match_settings: Dict[str, Any]) -> bool:
+    def apply_settings(item):
+        # Merged like the Redis store: settings not sent are kept
+        item["matchSettings"] = {**item.get("matchSettings", {}), **match_settings}
+
+    return _update_match(match_id, apply_settings) is not None
+
+
+# ----- Redis lobby store -----
+# Hot lobby state lives in Redis (see durable_func_app/reddis_schema.md):
+#   match:{id}:meta     HASH  host, createdAt and each match setting (JSON values)
+#   match:{id}:players  SET   player ids
+# Both keys expire LOBBY_TTL_SECONDS after the last change, so abandoned
+# lobbies clean themselves up. Only finished matches are written to Cosmos.
+LOBBY_TTL_SECONDS = 2 * 60 * 60
+
+# KEYS: meta, players. ARGV: ttl, host, field, value, ...
+# Returns 1, or 0 if the code is already taken.
+LOBBY_CREATE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: meta, players. ARGV: ttl, player_id
+# Returns 1 joined, -1 not found, -2 already in lobby, -3 full,
+# -4 maxPlayers is set but isn't a number.
+LOBBY_JOIN_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+if redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 1 then return -2 end
+local raw_max = redis.call('HGET', KEYS[1], 'maxPlayers')
+local max_players = tonumber(raw_max)
+if raw_max and not max_players then return -4 end
+if max_players and redis.call('SCARD', KEYS[2]) >= max_players then return -3 end
+redis.call('SADD', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: meta, players. ARGV: ttl, player_id
+# Returns 1 left, 0 left and lobby closed, -1 not found, -2 not in lobby.
+LOBBY_QUIT_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+if redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 0 then return -2 end
+if redis.call('SCARD', KEYS[2]) <= 1 then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return 0
+end
+redis.call('SREM', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+# KEYS: meta, players. ARGV: ttl, field, value, ...
+# Returns 1, or 0 if the lobby doesn't exist.
+LOBBY_SETTINGS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
+
+lobby_create_script = r.register_script(LOBBY_CREATE_LUA) if r else None
+lobby_join_script = r.register_script(LOBBY_JOIN_LUA) if r else None
+lobby_quit_script = r.register_script(LOBBY_QUIT_LUA) if r else None
+lobby_settings_script = r.register_script(LOBBY_SETTINGS_LUA) if r else None
+
+LOBBY_META_FIELDS = ("host", "createdAt")
+
+def _lobby_keys(match_id: str) -> list:
+    return [f"match:{match_id}:meta", f"match:{match_id}:players"]
+
+def _settings_args(match_settings: Dict[str, Any]) -> list:
+    args = []
+    for field, value in match_settings.items():
+        args += [field, json.dumps(value)]
+    return args
+
+def _redis_create(host_id: str, match_settings: Dict[str, Any]) -> str:
+    for _ in range(MATCH_CODE_ATTEMPTS):
+        match_id = _allocate_code()
+        args = [LOBBY_TTL_SECONDS, host_id, "host", json.dumps(host_id), "createdAt", json.dumps(_now_z())]
+        if lobby_create_script(keys=_lobby_keys(match_id), args=args + _settings_args(match_settings)):
+            return match_id
+        # the pool handed out a code with a live lobby; keep it leased
+        logging.warning(f"Lobby code {match_id} from pool was already in use")
+    raise RuntimeError("Could not allocate a free match code")
+
+def _redis_get(match_id: str) -> Optional[Dict[str, Any]]:
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(f"match:{match_id}:meta")
+    pipe.smembers(f"match:{match_id}:players")
+    meta, players = pipe.execute()
+    if not meta:
+        return None
+    meta = {field: json.loads(value) for field, value in meta.items()}
+    return {
+        "matchId": match_id,
+        "host": meta.get("host"),
+        "createdAt": meta.get("createdAt"),
+        "players": [{"userId": player_id} for player_id in sorted(players)],
+        "matchSettings": {k: v for k, v in meta.items() if k not in LOBBY_META_FIELDS},
+    }
+
+# ----- Lobby code pool -----
+# Free 6 digit codes are kept in a Redis SET and handed out with SPOP, so a
+# create never has to guess and retry however many lobbies are open.
+#   lobby:codes            SET     free codes
+#   lobby:codes:leased     ZSET    codes in use, score = lease expiry (unix seconds)
+#   lobby:codes:seed_next  STRING  how many codes have been added to the pool so far
+#   lobby:codes:seed_order HASH    secret multiplier and offset of the seeding order
+# The pool is filled lazily: whenever it holds fewer than CODE_SEED_CHUNK codes,
+# an allocation adds the next CODE_SEED_CHUNK, so no request does more than
+# that much seeding work. Codes come back on close/finish. Lobbies that expire
+# instead are picked up lazily: each allocation checks at most
+# CODE_RECLAIM_LIMIT expired leases.
+CODE_POOL_KEY = "lobby:codes"
+CODE_LEASES_KEY = "lobby:codes:leased"
+CODE_SEED_CURSOR_KEY = "lobby:codes:seed_next"
+CODE_SEED_ORDER_KEY = "lobby:codes:seed_order"
+CODE_EXHAUSTED_KEY = "lobby:codes:exhausted"
+CODE_RECLAIM_LIMIT = int(os.environ.get("CODE_RECLAIM_LIMIT", "20"))
+CODE_POOL_LOW_WATER = int(os.environ.get("CODE_POOL_LOW_WATER", "10000"))
+CODE_SEED_CHUNK = int(os.environ.get("CODE_SEED_CHUNK", "1000"))
+CODE_COUNT = 1000000
+
+# KEYS: pool, leases, seed cursor, seed order.
+# ARGV: now, lease_until, reclaim_limit, seed_chunk, multiplier, offset
+# Returns {code, codes still available}, with code "" if the pool is empty.
+# Codes are seeded in the order (i * multiplier + offset) mod 1e6, a
+# permutation since the multiplier is coprime with 1e6. Live lobbies all sit
+# early in that order, so it must not be guessable: the first seeding stores
+# a random multiplier and offset (ARGV, from _seed_order_candidate) and every
+# later chunk uses the stored pair.
+ALLOCATE_CODE_LUA = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[3]))
+for _, code in ipairs(expired) do
+    local ttl = redis.call('TTL', 'match:' .. code .. ':meta')
+    if ttl == -2 then
+        redis.call('ZREM', KEYS[2], code)
+        redis.call('SADD', KEYS[1], code)
+    elseif ttl == -1 then
+        redis.call('ZADD', KEYS[2], ARGV[2], code)
+    else
+        redis.call('ZADD', KEYS[2], tonumber(ARGV[1]) + ttl, code)
+    end
+end
+local cursor = tonumber(redis.call('GET', KEYS[3]) or '0')
+local chunk = tonumber(ARGV[4])
+if cursor < 1000000 and redis.call('SCARD', KEYS[1]) < chunk then
+    local order = redis.call('HMGET', KEYS[4], 'multiplier', 'offset')
+    local multiplier, offset = tonumber(order[1]), tonumber(order[2])
+    if not multiplier or not offset then
+        multiplier, offset = tonumber(ARGV[5]), tonumber(ARGV[6])
+        redis.call('HSET', KEYS[4], 'multiplier', multiplier, 'offset', offset)
+    end
+    local last = math.min(cursor + chunk, 1000000)
+    for i = cursor, last - 1 do
+        local code = string.format('%06d', (i * multiplier + offset) % 1000000)
+        if not redis.call('ZSCORE', KEYS[2], code) then
+            if redis.call('EXISTS', 'match:' .. code .. ':meta') == 1 then
+                redis.call('ZADD', KEYS[2], ARGV[2], code)
+            else
+                redis.call('SADD', KEYS[1], code)
+            end
+        end
+    end
+    cursor = last
+    redis.call('SET', KEYS[3], cursor)
+end
+local code = redis.call('SPOP', KEYS[1])
+if code then
+    redis.call('ZADD', KEYS[2], ARGV[2], code)
+end
+return {code or '', redis.call('SCARD', KEYS[1]) + 1000000 - cursor}
+"""
+
+allocate_code_script = r.register_script(ALLOCATE_CODE_LUA) if r else None
+
+def _seed_order_candidate() -> list:
+    """A random [multiplier, offset]; only used if the pool has no seeding order yet."""
+    multiplier = secrets.randbelow(CODE_COUNT)
+    while multiplier % 2 == 0 or multiplier % 5 == 0:
+        multiplier = secrets.randbelow(CODE_COUNT)
+    return [multiplier, secrets.randbelow(CODE_COUNT)]
+
+def _allocate_code() -> str:
+    now = int(time.time())
+    args = [now, now + LOBBY_TTL_SECONDS, CODE_RECLAIM_LIMIT, CODE_SEED_CHUNK] + _seed_order_candidate()
+    keys = [CODE_POOL_KEY, CODE_LEASES_KEY, CODE_SEED_CURSOR_KEY, CODE_SEED_ORDER_KEY]
+    code, available = allocate_code_script(keys=keys, args=args)
+    if not code:
+        r.incr(CODE_EXHAUSTED_KEY)
+        logging.warning("Lobby code pool exhausted")
+        raise RuntimeError("No free match codes")
+    if available < CODE_POOL_LOW_WATER:
+        logging.warning(f"Lobby code pool low: {available} free codes")
+    return code
+
+def _release_code(match_id: str) -> None:
+    pipe = r.pipeline(transaction=True)
+    pipe.zrem(CODE_LEASES_KEY, match_id)
+    pipe.sadd(CODE_POOL_KEY, match_id)
+    pipe.execute()
+
+def _code_pool_stats() -> Dict[str, Any]:
+    pipe = r.pipeline(transaction=False)
+    pipe.scard(CODE_POOL_KEY)
+    pipe.zcard(CODE_LEASES_KEY)
+    pipe.get(CODE_EXHAUSTED_KEY)
+    pipe.get(CODE_SEED_CURSOR_KEY)
+    free, leased, exhausted, seeded = pipe.execute()
+    return {"free": free, "leased": leased, "exhausted": int(exhausted or 0), "unseeded": CODE_COUNT - int(seeded or 0)}
+
+@app.route(route="lobby_code_pool", auth_level=func.AuthLevel.ADMIN, methods=["GET"])
+def lobby_code_pool(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        if r is None:
+            return _json({"result": False, "msg": "Redis not configured"}, 503)
+        return _json({"result": True, "msg": "OK", "pool": _code_pool_stats()})
+
+    except Exception as e:
+        logging.exception("lobby_code_pool failed")
+        return _json({"result": False, "msg": str(e)}, 500)
+
+# ----- Lobby store -----
+# Lobby operations go to Redis when it is configured, otherwise to Cosmos.
+
+def _lobby_create(host_id: str, match_settings: Dict[str, Any]) -> str:
+    if r is not None:
+        return _redis_create(host_id, match_settings)
+    return _reserve_match_code({
+        "host": host_id,
+        "createdAt": _now_z(),
+        "players": [{"userId": host_id}],
+        "matchSettings": match_settings,
+    })
+
+def _lobby_get(match_id: str) -> Optional[Dict[str, Any]]:
+    if r is not None:
+        return _redis_get(match_id)
+    return _get_match(match_id)
+
+def _lobby_join(match_id: str, player_id: str) -> bool:
+    """Returns False if the lobby doesn't exist, raises _LobbyConflict if the join is refused."""
+    if r is None:
+        return _cosmos_join(match_id, player_id)
+    status = lobby_join_script(keys=_lobby_keys(match_id), args=[LOBBY_TTL_SECONDS, player_id])
+    if status == -2:
+        raise _LobbyConflict("Player already in lobby", 409)
+    if status == -3:
+        raise _LobbyConflict("Lobby is full", 409)
+    if status == -4:
+        raise _LobbyConflict(LOBBY_MAX_PLAYERS_INVALID, 409)
+    return status == 1
+
+def _lobby_quit(match_id: str, player_id: str) -> Optional[bool]:
+    """Returns True if the lobby closed, False if the player left, None if not found."""
+    if r is None:
+        return _cosmos_quit(match_id, player_id)
+    status = lobby_quit_script(keys=_lobby_keys(match_id), args=[LOBBY_TTL_SECONDS, player_id])
+    if status == -1:
+        return None
+    if status == -2:
+        raise _LobbyConflict("Player isn't in lobby", 400)
+    if status == 0:
+        _release_code(match_id)
+    return status == 0
+
+def _lobby_update_settings(match_id: str, match_settings: Dict[str, Any]) -> bool:
+    """
+    Merges match_settings into the lobby's settings. Raises _LobbyConflict for
+    setting names that would overwrite lobby state in the Redis meta hash.
+    """
+    reserved = [field for field in match_settings if field in LOBBY_META_FIELDS]
+    if reserved:
+        raise _LobbyConflict(f"matchSettings can't include: {', '.join(reserved)}", 400)
+    if r is None:
+        return _cosmos_settings(match_id, match_settings)
+    if not match_settings:
+        return _redis_get(match_id) is not None
+    args = [LOBBY_TTL_SECONDS] + _settings_args(match_settings)
+    return bool(lobby_settings_script(keys=_lobby_keys(match_id), args=args))
+
+def _lobby_finish(match_id: str) -> None:
+    """
+    Persists the lobby as a finished match in Cosmos and releases its code.
+    The record gets its own id so the code can be reused by a later lobby.
+    """
+    lobby = _lobby_get(match_id)
+    if lobby is None:
+        return
+    finished_at = _now_z()
+    matches_container.upsert_item({
+        "id": f"{match_id}:{finished_at}",
+        "matchId": match_id,
+        "status": "finished",
+        "host": lobby.get("host"),
+        "createdAt": lobby.get("createdAt"),
+        "players": lobby.get("players", []),
+        "matchSettings": lobby.get("matchSettings", {}),
+        "finishedAt": finished_at,
+    })
+    if r is not None:
+        r.delete(*_lobby_keys(match_id))
+        _release_code(match_id)
+    else:
+        matches_container.delete_item(item=match_id, partition_key=match_id)
+
+def _last_finished_match(match_id: str) -> Optional[Dict[str, Any]]:
+    query = "SELECT TOP 1 * FROM c WHERE c.status = @status ORDER BY c.finishedAt DESC"
+    params = [{"name": "@status", "value": "finished"}]
+    found = list(matches_container.query_items(query=query, parameters=params, partition_key=match_id))
+    return found[0] if found else None
+
+def _game_identity(match_id: str, lobby: Optional[Dict[str, Any]]) -> tuple:
+    """
+    Returns (game_key, created_at) for the game played under a match code:
+    the live lobby's, or the last finished one's once the lobby is gone.
+    Codes are reused, so the code plus the lobby's createdAt names one game.
+    Falls back to the bare code for lobbies that predate createdAt.
+    """
+    created_at = lobby.get("createdAt") if lobby else None
+    if created_at is None:
+        finished = _last_finished_match(match_id)
+        created_at = finished.get("createdAt") if finished else None
+    if created_at is None:
+        return match_id, None
+    return f"{match_id}:{created_at}", created_at
+
+
+# ----- SignalR groups -----
+# Each match has a SignalR group named after its matchCode. Connections are
+# negotiated with the player's userId, and the lobby endpoints add/remove that
+# user from the group so the durable app can send round messages to one match.
+
+def _group_action(user_id: str, match_id: str, action: str) -> str:
+    return json.dumps({"userId": user_id, "groupName": match_id, "action": action})
+
 ## Start game
 ## Initialises a lobby for the game
 ## Returns a game ID and signal R access token
 @app.route(route="create_lobby", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-@app.generic_input_binding(arg_name="connectionInfo", type="signalRConnectionInfo", hubName="test", connectionStringSetting="AZURE_SIGNALR_CONNECTION_STRING")
-def create_lobby(req: func.HttpRequest, connectionInfo) -> func.HttpResponse:
+@app.generic_input_binding(arg_name="connectionInfo", type="signalRConnectionInfo", hubName="test", userId="{userId}", connectionStringSetting="AZURE_SIGNALR_CONNECTION_STRING")
+@app.generic_output_binding(arg_name="signalRGroupActions", type="signalR", hubName="test", connectionStringSetting="AZURE_SIGNALR_CONNECTION_STRING")
+def create_lobby(req: func.HttpRequest, connectionInfo, signalRGroupActions: func.Out[str]) -> func.HttpResponse:
     # Expects:
     # {userId: "id"}
 
     # Adds to matches container:
     # {matchCode: "unique 6 digit code",
-    # players: [{userId: "uuid"}] matchSettings:{noOfRounds:int, maxPlayers:int, countdown:int}"}
+    # players: [{userId: "uuid"}] matchSettings:{noOfRounds:int, maxPlayers:int, countdown:int, scoringProfile:str}"}
 
     try:
         body = req.get_json()
         host_id = body['userId']
         
-        # generate 6 character match code
-        match_id = random.randint(0, 999999)
-        match_id = f"{match_id:06d}"
-
-        # Check if a code already exists within the matches container
-        query = "SELECT VALUE COUNT(1) FROM matches m WHERE m.matchId = @matchId"
-        items = list(matches_container.query_items(
-            query=query,
-            parameters=[{"name": "@matchId", "value": match_id}],
-            enable_cross_partition_query=True
-        ))
-
-        # If matchId already exists, regenerate
-        while items[0] > 0:
-            # generate 6 character match code
-            match_id = random.randint(0, 999999)
-            match_id = f"{match_id:06d}"
-
-            items = list(matches_container.query_items(
-                query=query,
-                parameters=[{"name": "@matchId", "value": match_id}],
-                enable_cross_partition_query=True
-            ))
-
-        hub_name = match_id
-
-        # add match to matches container
-        default_match_settings = {"noOfRounds":3, "maxPlayers":8, "countdown":60}
-        doc = {"matchId": match_id, "players": [{"userId": host_id}], "matchSettings": default_match_settings}
-        matches_container.create_item(doc, enable_automatic_id_generation = True)
+        # add match to the lobby store
+        default_match_settings = {"noOfRounds":3, "maxPlayers":8, "countdown":60, "scoringProfile": DEFAULT_SCORING_PROFILE}
+        match_id = _lobby_create(host_id, default_match_settings)
+        signalRGroupActions.set(_group_action(host_id, match_id, "add"))
 
         parsed_connection_info = json.loads(connectionInfo)
         connection_url = parsed_connection_info["url"]
@@ -494,8 +2124,9 @@ def create_lobby(req: func.HttpRequest, connectionInfo) -> func.HttpResponse:
 # Adds player to the lobby
 # Returns signal R access token
 @app.route(route="join_game", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-@app.generic_input_binding(arg_name="connectionInfo", type="signalRConnectionInfo", hubName="test", connectionStringSetting="AZURE_SIGNALR_CONNECTION_STRING")
-def join_game(req: func.HttpRequest, connectionInfo) -> func.HttpResponse:
+@app.generic_input_binding(arg_name="connectionInfo", type="signalRConnectionInfo", hubName="test", userId="{playerId}", connectionStringSetting="AZURE_SIGNALR_CONNECTION_STRING")
+@app.generic_output_binding(arg_name="signalRGroupActions", type="signalR", hubName="test", connectionStringSetting="AZURE_SIGNALR_CONNECTION_STRING")
+def join_game(req: func.HttpRequest, connectionInfo, signalRGroupActions: func.Out[str]) -> func.HttpResponse:
     # Expects:
     # {matchCode: str, playerId: str}
 
@@ -507,37 +2138,15 @@ def join_game(req: func.HttpRequest, connectionInfo) -> func.HttpResponse:
         match_id = body['matchCode']
         player_id = body['playerId']
 
-        # fetch current lobby state
-        query = "SELECT * FROM matches m WHERE m.matchId = @matchId"
-        items = list(matches_container.query_items(
-            query=query,
-            parameters=[{"name": "@matchId", "value": match_id}],
-            enable_cross_partition_query=True
-        ))
-
-        if not items:
+        try:
+            joined = _lobby_join(match_id, player_id)
+        except _LobbyConflict as e:
+            return _json({"result": False, "msg": e.msg}, e.status)
+        if not joined:
             return _json({"result": False, "msg": "Match not found"}, 404)
-
-        item = items[0]
-        players = item.get("players", [])
-
-        max_players = item["matchSettings"]["maxPlayers"]
-
-        player_in_lobby = any(player["userId"] == player_id for player in players)
-        lobby_count_exceeded = len(players) >= max_players
-
-        if (player_in_lobby):
-            return _json({"result": False, "msg": "Player already in lobby"}, 409)
-        elif (lobby_count_exceeded):
-            return _json({"result": False, "msg": "Lobby is full"}, 409)
         else:
-            hub_name = match_id
-
+            signalRGroupActions.set(_group_action(player_id, match_id, "add"))
 
-            # replace entry
-            item["players"].append({"userId": player_id})
-            matches_container.upsert_item(item)
-            
             parsed_connection_info = json.loads(connectionInfo)
             connection_url = parsed_connection_info["url"]
             connection_token = parsed_connection_info["accessToken"]
@@ -556,7 +2165,8 @@ def join_game(req: func.HttpRequest, connectionInfo) -> func.HttpResponse:
 # Quit game
 # Removes player from the lobby
 @app.route(route="quit_game", auth_level=func.AuthLevel.FUNCTION, methods=["POST"])
-def quit_game(req: func.HttpRequest) -> func.HttpResponse:
+@app.generic_output_binding(arg_name="signalRGroupActions", type="signalR", hubName="test", connectionStringSetting="AZURE_SIGNALR_CONNECTION_STRING")
+def quit_game(req: func.HttpRequest, signalRGroupActions: func.Out[str]) -> func.HttpResponse:
     # Expects:
     # {matchCode: str, playerId: str}
 
@@ -566,32 +2176,16 @@ def quit_game(req: func.HttpRequest) -> func.HttpResponse:
         match_id = body['matchCode']
         player_id = body['playerId']
 
-        # fetch current lobby state
-        query = "SELECT * FROM matches m WHERE m.matchId = @matchId"
-        params = [{"name": "@matchId", "value": match_id}]
-        items = list(matches_container.query_items(query=query, parameters=params, enable_cross_partition_query=True))[0]
-
-        if not items:
+        try:
+            closed = _lobby_quit(match_id, player_id)
+        except _LobbyConflict as e:
+            return _json({"result": False, "msg": e.msg}, e.status)
+        if closed is None:
             return _json({"result": False, "msg": "Lobby not found"}, 404)
-        item = items[0]
-
-        players = item["players"]
-
-        player_in_lobby = any(player["userId"] == player_id for player in players)
-        lobby_empty = len(players) <= 1
-
-        if (not player_in_lobby):
-            return _json({"result": False, "msg": "Player isn't in lobby"}, 400)
-        elif (lobby_empty):
-            # delete entry
-            matches_container.delete_item(item)
+        signalRGroupActions.set(_group_action(player_id, match_id, "remove"))
+        if closed:
             return _json({"result": True, "msg": "Lobby closed"}, 200)
-        else:
-            # replace entry
-            item["players"] = [player for player in players if player["userId"] != player_id]
-            matches_container.upsert_item(item)
-
-            return _json({"result": True, "msg": "OK"}, 200)
+        return _json({"result": True, "msg": "OK"}, 200)
 
     except Exception as e:
         logging.exception("Error in quit_game")
@@ -602,24 +2196,26 @@ def quit_game(req: func.HttpRequest) -> func.HttpResponse:
 # Takes new settings and changes it in the database
 @app.route(route="change_settings", auth_level=func.AuthLevel.FUNCTION, methods=["PUT"])
 def settings(req: func.HttpRequest) -> func.HttpResponse:
-    # expects: {matchCode: code, matchSettings:{noOfRounds:int, maxPlayers:int, countdown:int}}
+    # expects: {matchCode: code, matchSettings:{noOfRounds:int, maxPlayers:int, countdown:int, scoringProfile:str}}
     
     try:
         body = req.get_json()
         match_id = body['matchCode']
         match_settings = body["matchSettings"]
 
-        # fetch current lobby state
-        query = "SELECT * FROM matches m WHERE m.matchId = @matchId"
-        params = [{"name": "@matchId", "value": match_id}]
-        items = list(matches_container.query_items(query=query, parameters=params, enable_cross_partition_query=True))
-        if not items:
+        profile = match_settings.get("scoringProfile")
+        if profile is not None and profile not in SCORING_PROFILES:
+            return _json({"result": False, "msg": f"scoringProfile must be one of: {', '.join(SCORING_PROFILES)}"}, 400)
+        max_players = match_settings.get("maxPlayers")
+        if max_players is not None and not (_is_number(max_players) and max_players >= 1):
+            return _json({"result": False, "msg": "maxPlayers must be a positive number"}, 400)
+
+        try:
+            updated = _lobby_update_settings(match_id, match_settings)
+        except _LobbyConflict as e:
+            return _json({"result": False, "msg": e.msg}, e.status)
+        if not updated:
             return _json({"result": False, "msg": "Lobby not found"}, 404)
-        item = items[0]
-        
-        # update entry
-        item["matchSettings"] = match_settings
-        matches_container.upsert_item(item)
 
         return _json({"result": True, "msg": "OK"}, 201)
 
@@ -645,6 +2241,16 @@ def guess(req: func.HttpRequest) -> func.HttpResponse:
         if not (-90 <= lat <= 90 and -180 <= lon <= 180):
             raise ValueError("Invalid coordinates")
 
+        if GUESS_INGESTION_MODE == "redis" and score_guess_script is not None:
+            try:
+                entry = _record_guess_in_redis(match_id, player_id, lat, lon, round_no)
+            except redis.RedisError:
+                logging.warning("guess: Redis unavailable, falling back to the queue", exc_info=True)
+            else:
+                if entry is None:
+                    return _json({"result": False, "msg": "Round not active"}, 409)
+                return _json({"result": True, "msg": "OK"}, 200)
+
         # Add to service bus queue
         _enqueue_guess(match_id, player_id, lat, lon, round_no)
 
@@ -687,10 +2293,29 @@ def results(req: func.HttpRequest) -> func.HttpResponse:
         if not match_id:
             return _json({"result": False, "msg": "Missing matchCode/match_id/game_id"}, 400)
 
-        # Pull ALL Results docs for this game (one per round)
+        # A retried call gets the stored outcome instead of scoring the game twice.
+        # Once the lobby is gone that is the last game completed under the code.
+        lobby = _lobby_get(match_id)
+        if lobby is None:
+            finalization = _get_finalization(_last_finalization_id(match_id))
+            if finalization:
+                return _finalization_response(finalization)
+        game_key, created_at = _game_identity(match_id, lobby)
+        finalization = _get_finalization(game_key)
+        if finalization and _finalization_settled(finalization):
+            return _finalization_response(finalization)
+
+        # Pull ALL Results docs for this game (one per round). Earlier games
+        # under the same code were written before this lobby was created.
+        query = "SELECT * FROM c WHERE c.game_id = @game_id"
+        params = [{"name": "@game_id", "value": match_id}]
+        if created_at:
+            query += " AND c._ts >= @since"
+            since = datetime.datetime.fromisoformat(created_at.replace("Z", "+00:00")).timestamp()
+            params.append({"name": "@since", "value": int(since)})
         items = list(results_container.query_items(
-            query="SELECT * FROM c WHERE c.game_id = @game_id",
-            parameters=[{"name": "@game_id", "value": match_id}],
+            query=query,
+            parameters=params,
             enable_cross_partition_query=True
         ))
 
@@ -715,23 +2340,50 @@ def results(req: func.HttpRequest) -> func.HttpResponse:
         # Update scores once per player using the accumulated totals
         updated = []
         skipped = []
+        deltas = {}
+        display_names = {}
+        lookups = {pid: player_executor.submit(_get_user_by_user_id, pid) for pid in totals}
         for pid, delta in totals.items():
-            user = _get_user_by_user_id(pid)
+            try:
+                user = lookups[pid].result()
+            except Exception:
+                logging.exception(f"results: user lookup failed for player_id={pid}")
+                skipped.append({"player_id": pid, "reason": "user_lookup_failed"})
+                continue
             if not user:
                 skipped.append({"player_id": pid, "reason": "user_not_found"})
                 continue
 
-            display_name = user.get("displayName", "") or user.get("username", "") or ""
-
             if delta > 0:
-                _inc_score(pid, "alltime", display_name, delta)
-                _inc_score(pid, _month_scope(), display_name, delta)
+                deltas[pid] = delta
+                display_names[pid] = user.get("displayName", "") or user.get("username", "") or ""
+
+        finalization = _claim_finalization(game_key, match_id, totals)
+        if finalization:
+            return _finalization_response(finalization)
+
+        failed = _apply_score_deltas(deltas, display_names, game_key)
+        for pid, delta in deltas.items():
+            if pid in failed:
+                skipped.append({"player_id": pid, "reason": "score_update_failed"})
+            else:
                 updated.append({"player_id": pid, "delta": delta})
 
-        return _json(
-            {"result": True, "msg": "OK", "game_id": match_id, "totals": totals, "updated": updated, "skipped": skipped},
-            200
-        )
+        logging.info(f"results: user cache stats={_user_cache_stats()}")
+
+        response = {"result": True, "msg": "OK", "game_id": match_id, "totals": totals, "updated": updated, "skipped": skipped}
+        if failed:
+            # Not final yet: a retry re-runs the failed players, the rest are skipped by their markers
+            _release_finalization(game_key, match_id, totals)
+            return _json(response, 200)
+        _complete_finalization(game_key, match_id, totals, response)
+
+        try:
+            _lobby_finish(match_id)
+        except Exception:
+            logging.exception(f"results: failed to persist finished match {match_id}")
+
+        return _json(response, 200)
 
     except Exception as e:
         logging.exception("results: error")
@@ -0,0 +1,83 @@
+import importlib.util
+import os
+from unittest import mock
+
+import fakeredis
+import pytest
+
+from cosmos_fakes import FakeContainer
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Settings the apps read at import time. The clients built from them are
+# patched out below, so nothing here is ever connected to.
+APP_SETTINGS = {
+    "COSMOS_CONNECTION_STRING": "AccountEndpoint=https://localhost:8081/;AccountKey=dGVzdA==;",
+    "AZURE_SIGNALR_CONNECTION_STRING": "Endpoint=https://localhost;AccessKey=dGVzdA==;Version=1.0;",
+    "SIGNALR_ENDPOINT": "https://localhost",
+    "AZURE_STORAGE_CONNECTION_STRING": "DefaultEndpointsProtocol=https;AccountName=test;AccountKey=dGVzdA==;EndpointSuffix=core.windows.net",
+}
+
+
+def _load_app(app_dir: str, module_name: str):
+    # Every app's module is called function_app, so load each under its own name
+    path = os.path.join(BACKEND_DIR, app_dir, "function_app.py")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def func_app():
+    env = {k: v for k, v in os.environ.items() if k not in ("RedisHost", "ServiceBusConnection")}
+    env.update(APP_SETTINGS)
+    with mock.patch.dict(os.environ, env, clear=True), \
+            mock.patch("azure.cosmos.CosmosClient.from_connection_string"), \
+            mock.patch("azure.storage.blob.BlobServiceClient.from_connection_string"):
+        return _load_app("func_app", "func_app_function_app")
+
+
+@pytest.fixture(scope="session")
+def background_app():
+    return _load_app("background_func_app", "background_function_app")
+
+
+@pytest.fixture(scope="session")
+def durable_app():
+    env = {k: v for k, v in os.environ.items() if k != "RedisHost"}
+    env["CosmosDBConnectionString"] = APP_SETTINGS["COSMOS_CONNECTION_STRING"]
+    with mock.patch.dict(os.environ, env, clear=True), \
+            mock.patch("azure.cosmos.CosmosClient.from_connection_string"):
+        return _load_app("durable_func_app", "durable_function_app")
+
+
+@pytest.fixture
+def fake_cosmos(func_app, monkeypatch):
+    """Swaps func_app's container clients for empty in-memory ones, with cold caches."""
+    containers = {
+        "users_container": FakeContainer("/id"),
+        "usernames_container": FakeContainer("/id"),
+        "scores_container": FakeContainer("/userId"),
+        "leaderboard_container": FakeContainer("/scope"),
+        "results_container": FakeContainer("/game_id"),
+        "finalizations_container": FakeContainer("/id"),
+        "matches_container": FakeContainer("/matchId"),
+    }
+    for name, container in containers.items():
+        monkeypatch.setattr(func_app, name, container)
+    monkeypatch.setattr(func_app, "user_cache", func_app._TTLCache(2000, 300))
+    monkeypatch.setattr(func_app, "username_cache", func_app._TTLCache(2000, 300))
+    monkeypatch.setattr(func_app, "username_miss_cache", func_app._TTLCache(2000, 60))
+    return containers
+
+
+@pytest.fixture
+def fake_redis(func_app, monkeypatch):
+    """Points func_app at an in-memory Redis and registers every *_LUA script on it."""
+    server = fakeredis.FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr(func_app, "r", server)
+    for name in dir(func_app):
+        if name.endswith("_LUA") and hasattr(func_app, f"{name[:-4].lower()}_script"):
+            monkeypatch.setattr(func_app, f"{name[:-4].lower()}_script", server.register_script(getattr(func_app, name)))
+    return server
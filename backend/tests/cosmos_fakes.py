@@ -0,0 +1,188 @@
+"""
+In-memory stand-in for a Cosmos container client.
+
+Covers the calls the apps make: point reads, create / replace / upsert /
+delete with ETag preconditions, transactional batches with patch, and the
+simple WHERE clauses the apps query with. `latency` is slept on every call
+to stand in for the network round trip, which is what the fan-out benchmarks
+are measuring.
+"""
+import copy
+import itertools
+import re
+import threading
+import time
+
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+
+_CONDITION = re.compile(r"c\.(\w+)\s*(>=|<=|!=|=|>|<)\s*(@\w+)")
+_ARRAY_CONTAINS = re.compile(r"ARRAY_CONTAINS\((@\w+),\s*c\.(\w+)\)")
+_IS_DEFINED = re.compile(r"IS_DEFINED\(c\.(\w+)\)")
+_VALUE = re.compile(r"SELECT (?:TOP \d+ )?VALUE c\.(\w+)")
+_TOP = re.compile(r"SELECT TOP (\d+)")
+
+_OPS = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    "<": lambda a, b: a is not None and a < b,
+}
+
+
+class FakeContainer:
+
+    def __init__(self, pk_path: str = "/id", latency: float = 0.0):
+        self.pk_field = pk_path.lstrip("/")
+        self.latency = latency
+        self.items = {}  # (pk, id) -> doc
+        self.calls = 0
+        self._etags = itertools.count(1)
+        self._lock = threading.Lock()
+
+    # ----- helpers -----
+    def _round_trip(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _stamp(self, doc):
+        doc = copy.deepcopy(doc)
+        doc["_etag"] = f'"{next(self._etags)}"'
+        doc["_ts"] = int(time.time())
+        return doc
+
+    def _key(self, doc):
+        return (doc[self.pk_field], doc["id"])
+
+    def _check_etag(self, current, etag, match_condition):
+        if etag is not None and match_condition == MatchConditions.IfNotModified and current["_etag"] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+
+    @staticmethod
+    def _not_found():
+        return exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+
+    @staticmethod
+    def _exists():
+        return exceptions.CosmosResourceExistsError(status_code=409, message="Conflict")
+
+    # ----- item operations -----
+    def read_item(self, item, partition_key, **kwargs):
+        self._round_trip()
+        with self._lock:
+            doc = self.items.get((partition_key, item))
+            if doc is None:
+                raise self._not_found()
+            return copy.deepcopy(doc)
+
+    def create_item(self, body, **kwargs):
+        self._round_trip()
+        with self._lock:
+            key = self._key(body)
+            if key in self.items:
+                raise self._exists()
+            self.items[key] = self._stamp(body)
+            return copy.deepcopy(self.items[key])
+
+    def upsert_item(self, body, **kwargs):
+        self._round_trip()
+        with self._lock:
+            key = self._key(body)
+            self.items[key] = self._stamp(body)
+            return copy.deepcopy(self.items[key])
+
+    def replace_item(self, item, body, etag=None, match_condition=None, **kwargs):
+        self._round_trip()
+        with self._lock:
+            key = (body[self.pk_field], item)
+            current = self.items.get(key)
+            if current is None:
+                raise self._not_found()
+            self._check_etag(current, etag, match_condition)
+            self.items[key] = self._stamp(body)
+            return copy.deepcopy(self.items[key])
+
+    def delete_item(self, item, partition_key, etag=None, match_condition=None, **kwargs):
+        self._round_trip()
+        item_id = item["id"] if isinstance(item, dict) else item
+        with self._lock:
+            current = self.items.get((partition_key, item_id))
+            if current is None:
+                raise self._not_found()
+            self._check_etag(current, etag, match_condition)
+            del self.items[(partition_key, item_id)]
+
+    # ----- transactional batch -----
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        self._round_trip()
+        with self._lock:
+            staged = dict(self.items)
+            responses = []
+            for index, (op, args) in enumerate(batch_operations):
+                try:
+                    doc = self._batch_op(staged, partition_key, op, args)
+                except exceptions.CosmosHttpResponseError as e:
+                    failed = [{"statusCode": 424} for _ in batch_operations]
+                    failed[index] = {"statusCode": e.status_code}
+                    raise exceptions.CosmosBatchOperationError(
+                        error_index=index,
+                        headers={},
+                        status_code=e.status_code,
+                        message=f"Batch operation {index} failed",
+                        operation_responses=failed,
+                    )
+                responses.append({"statusCode": 200, "resourceBody": copy.deepcopy(doc)})
+            self.items = staged
+            return responses
+
+    def _batch_op(self, staged, partition_key, op, args):
+        if op == "create":
+            doc = args[0]
+            if (partition_key, doc["id"]) in staged:
+                raise self._exists()
+            staged[(partition_key, doc["id"])] = self._stamp(doc)
+        elif op == "upsert":
+            doc = args[0]
+            staged[(partition_key, doc["id"])] = self._stamp(doc)
+        elif op == "patch":
+            item_id, patch_ops = args
+            current = staged.get((partition_key, item_id))
+            if current is None:
+                raise self._not_found()
+            doc = copy.deepcopy(current)
+            for patch in patch_ops:
+                field = patch["path"].lstrip("/")
+                if patch["op"] == "incr":
+                    doc[field] = doc.get(field, 0) + patch["value"]
+                else:
+                    doc[field] = patch["value"]
+            staged[(partition_key, item_id)] = self._stamp(doc)
+        else:
+            raise NotImplementedError(op)
+        return staged[(partition_key, args[0]["id"] if op != "patch" else args[0])]
+
+    # ----- queries -----
+    def query_items(self, query, parameters=None, partition_key=None, **kwargs):
+        self._round_trip()
+        params = {p["name"]: p["value"] for p in parameters or []}
+        with self._lock:
+            docs = [
+                copy.deepcopy(doc) for (pk, _), doc in self.items.items()
+                if partition_key is None or pk == partition_key
+            ]
+        for field, op, name in _CONDITION.findall(query):
+            docs = [d for d in docs if _OPS[op](d.get(field), params[name])]
+        for name, field in _ARRAY_CONTAINS.findall(query):
+            docs = [d for d in docs if d.get(field) in params[name]]
+        for field in _IS_DEFINED.findall(query):
+            docs = [d for d in docs if field in d]
+        top = _TOP.search(query)
+        if top:
+            docs = docs[:int(top.group(1))]
+        value = _VALUE.search(query)
+        if value:
+            return [d.get(value.group(1)) for d in docs]
+        return docs
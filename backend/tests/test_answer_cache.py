@@ -0,0 +1,36 @@
+import json
+
+
+def _answer(**extra) -> str:
+    return json.dumps({"lat": 50.9, "lon": -1.4, **extra})
+
+
+def test_answer_is_cached_for_its_round(background_app):
+    answer, ttl = background_app._parse_answer("k", _answer(round_seconds=30))
+
+    assert answer == (50.9, -1.4, background_app._profile_name(None))
+    assert ttl == 30 + background_app.ANSWER_CACHE_GRACE_SECONDS
+
+
+def test_long_rounds_are_capped(background_app):
+    _, ttl = background_app._parse_answer("k", _answer(round_seconds=600))
+
+    assert ttl == background_app.ANSWER_CACHE_TTL_SECONDS
+
+
+def test_answers_without_a_round_length_use_the_default(background_app):
+    _, ttl = background_app._parse_answer("k", _answer())
+
+    assert ttl == background_app.ANSWER_CACHE_TTL_SECONDS
+
+
+def test_entry_expires_with_its_ttl(background_app, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(background_app.time, "monotonic", lambda: now[0])
+    cache = background_app._AnswerCache(10, ttl_seconds=120, negative_ttl_seconds=2)
+
+    cache.set(("111111", 1), (50.9, -1.4, "city-strict"), 40)
+    now[0] += 39
+    assert cache.get(("111111", 1)) == (50.9, -1.4, "city-strict")
+    now[0] += 2
+    assert cache.get(("111111", 1)) is None
@@ -0,0 +1,39 @@
+import json
+
+import fakeredis
+import pytest
+
+GAME_ID = "666666"
+ANSWER = {"lat": 50.9352, "lon": -1.3960}
+
+
+@pytest.fixture
+def geo_redis(durable_app, monkeypatch):
+    server = fakeredis.FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr(durable_app, "r", server)
+    monkeypatch.setattr(durable_app, "SCORING_ENGINE", "geo")
+    monkeypatch.setattr(durable_app, "geo_rank_script", server.register_script(durable_app.GEO_RANK_LUA))
+    return server
+
+
+def _guess(server, player_id: str, lat: float, lon: float) -> None:
+    server.geoadd(f"match:{GAME_ID}:round:1:geo", [lon, lat, player_id])
+
+
+def test_round_is_ranked_nearest_first(durable_app, geo_redis):
+    durable_app._store_answers(GAME_ID, {1: {"location": ANSWER}}, None, 30)
+    _guess(geo_redis, "far", 50.95, -1.40)
+    _guess(geo_redis, "near", 50.9353, -1.3961)
+
+    guesses = {pid: json.loads(g) for pid, g in durable_app._geo_round_guesses(GAME_ID, 1).items()}
+
+    assert list(guesses) == ["near", "far"]
+    assert guesses["near"]["dist_km"] < 0.1 < guesses["far"]["dist_km"]
+    assert guesses["near"]["score"] > guesses["far"]["score"] > 0
+
+
+def test_missing_answer_member_means_no_guesses(durable_app, geo_redis):
+    # _store_answers failed, but guesses still came in
+    _guess(geo_redis, "alice", 50.9353, -1.3961)
+
+    assert durable_app._geo_round_guesses(GAME_ID, 1) == {}
@@ -0,0 +1,69 @@
+import json
+
+import azure.functions as func
+import fakeredis
+import pytest
+import redis
+
+
+class FailingPipeline:
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self._pipe, name)
+
+    def execute(self):
+        raise redis.ConnectionError("connection reset")
+
+
+@pytest.fixture
+def guess_redis(background_app, monkeypatch):
+    server = fakeredis.FakeStrictRedis(decode_responses=True)
+    monkeypatch.setattr(background_app, "r", server)
+    monkeypatch.setattr(background_app, "answer_cache", background_app._AnswerCache(100, 120, 2))
+    server.set("match:111111:round:1:answer", json.dumps({"lat": 50.9352, "lon": -1.3960}))
+    return server
+
+
+def _batch(count: int) -> list:
+    return [
+        func.ServiceBusMessage(body=json.dumps({
+            "game_id": "111111", "player_id": f"player-{i}", "lat": 50.935, "lon": -1.396, "round_no": 1,
+        }).encode())
+        for i in range(count)
+    ]
+
+
+def test_batch_is_scored_and_stored(background_app, guess_redis):
+    background_app.process_guess_queue(_batch(3))
+
+    assert len(guess_redis.hgetall("match:111111:round_guesses")) == 3
+
+
+def test_answer_read_failure_fails_the_batch(background_app, guess_redis, monkeypatch):
+    monkeypatch.setattr(guess_redis, "mget", lambda keys: (_ for _ in ()).throw(redis.ConnectionError("timeout")))
+
+    with pytest.raises(redis.ConnectionError):
+        background_app.process_guess_queue(_batch(3))
+
+
+def test_write_failure_fails_the_batch_and_redelivery_stores_it(background_app, guess_redis, monkeypatch):
+    pipeline = guess_redis.pipeline
+    with monkeypatch.context() as m:
+        m.setattr(guess_redis, "pipeline", lambda **kwargs: FailingPipeline(pipeline(**kwargs)))
+        with pytest.raises(redis.ConnectionError):
+            background_app.process_guess_queue(_batch(3))
+
+    background_app.process_guess_queue(_batch(3))
+    assert len(guess_redis.hgetall("match:111111:round_guesses")) == 3
+
+
+def test_geo_write_failure_fails_the_batch(background_app, guess_redis, monkeypatch):
+    monkeypatch.setattr(background_app, "SCORING_ENGINE", "geo")
+    pipeline = guess_redis.pipeline
+    monkeypatch.setattr(guess_redis, "pipeline", lambda **kwargs: FailingPipeline(pipeline(**kwargs)))
+
+    with pytest.raises(redis.ConnectionError):
+        background_app.process_guess_queue(_batch(3))
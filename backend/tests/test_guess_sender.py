@@ -0,0 +1,180 @@
+"""
+Load benchmark for queueing guesses: concurrent requests against a stand-in
+Service Bus that charges a connection handshake per client and a round trip
+per send. Compares a new client per guess (the old _enqueue_guess), the
+pooled sender, and the pooled sender in batch mode.
+
+    pytest backend/tests/test_guess_sender.py --benchmark-columns=mean,rounds
+    (guesses/s and p99 are in each benchmark's extra_info, see --benchmark-json)
+"""
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+CONNECT_LATENCY_SECONDS = 0.03
+SEND_LATENCY_SECONDS = 0.003
+CONCURRENT_REQUESTS = 16
+GUESSES_PER_REQUEST_THREAD = 25
+
+
+class FakeBatch(list):
+
+    def add_message(self, message):
+        self.append(message)
+
+
+class FakeSender:
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def create_message_batch(self):
+        return FakeBatch()
+
+    def send_messages(self, message, timeout=None):
+        if self.bus.hang.is_set():
+            self.bus.release.wait()
+        time.sleep(self.bus.send_latency)
+        with self.bus.lock:
+            self.bus.sends += 1
+            self.bus.messages += len(message) if isinstance(message, FakeBatch) else 1
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeServiceBus:
+    """Stands in for the ServiceBusClient class."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.sends = 0
+        self.messages = 0
+        self.send_latency = SEND_LATENCY_SECONDS
+        self.hang = threading.Event()
+        self.release = threading.Event()
+
+    def from_connection_string(self, conn_str):
+        time.sleep(CONNECT_LATENCY_SECONDS)
+        with self.lock:
+            self.connections += 1
+        return self
+
+    def get_queue_sender(self, queue_name):
+        return FakeSender(self)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.fixture
+def bus(func_app, monkeypatch):
+    fake = FakeServiceBus()
+    monkeypatch.setattr(func_app, "ServiceBusClient", fake)
+    yield fake
+    fake.release.set()
+
+
+def _per_guess_client(func_app):
+    # The old _enqueue_guess: a new AMQP connection and link for every guess
+    def send(message):
+        with func_app.ServiceBusClient.from_connection_string("conn") as client:
+            with client.get_queue_sender(func_app.GUESS_QUEUE_NAME) as sender:
+                sender.send_messages(message)
+    return send
+
+
+def _load(send, message) -> dict:
+    latencies = []
+    lock = threading.Lock()
+
+    def request_thread():
+        for _ in range(GUESSES_PER_REQUEST_THREAD):
+            started = time.perf_counter()
+            send(message)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENT_REQUESTS) as pool:
+        for future in [pool.submit(request_thread) for _ in range(CONCURRENT_REQUESTS)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+    return {
+        "guesses_per_second": round(len(latencies) / elapsed),
+        "p99_ms": round(statistics.quantiles(latencies, n=100)[98] * 1000, 1),
+    }
+
+
+@pytest.mark.parametrize("mode", ["per_guess_client", "pooled", "pooled_batch"])
+def test_guess_throughput(benchmark, func_app, bus, monkeypatch, mode):
+    monkeypatch.setattr(func_app, "GUESS_BATCH_MODE", mode == "pooled_batch")
+    if mode == "per_guess_client":
+        send = _per_guess_client(func_app)
+    else:
+        send = func_app._GuessSender("conn", func_app.GUESS_QUEUE_NAME).send
+    message = func_app.ServiceBusMessage("{}")
+
+    stats = benchmark.pedantic(_load, args=(send, message), rounds=1, iterations=1)
+    benchmark.extra_info.update(stats)
+    benchmark.extra_info["connections"] = bus.connections
+
+    assert bus.messages == CONCURRENT_REQUESTS * GUESSES_PER_REQUEST_THREAD
+    if mode != "per_guess_client":
+        assert bus.connections <= func_app.GUESS_SENDER_POOL_SIZE
+
+
+def test_concurrent_sends_do_not_queue_behind_one_link(func_app, bus):
+    sender = func_app._GuessSender("conn", func_app.GUESS_QUEUE_NAME, pool_size=4)
+    message = func_app.ServiceBusMessage("{}")
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: sender.send(message), range(4)))  # open every link
+
+    bus.send_latency = 0.05
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda _: sender.send(message), range(4)))
+    elapsed = time.perf_counter() - started
+
+    # One link at a time would take 4 round trips
+    assert elapsed < 2 * bus.send_latency
+
+
+def test_hung_send_times_out_waiting_callers(func_app, bus, monkeypatch):
+    monkeypatch.setattr(func_app, "GUESS_SEND_TIMEOUT_SECONDS", 0.2)
+    sender = func_app._GuessSender("conn", func_app.GUESS_QUEUE_NAME, pool_size=1)
+    message = func_app.ServiceBusMessage("{}")
+    bus.hang.set()
+
+    stuck = threading.Thread(target=sender.send, args=(message,), daemon=True)
+    stuck.start()
+    time.sleep(CONNECT_LATENCY_SECONDS * 2)
+
+    with pytest.raises(TimeoutError):
+        sender.send(message)
+
+
+def test_batch_mode_caller_times_out_on_a_hung_flush(func_app, bus, monkeypatch):
+    monkeypatch.setattr(func_app, "GUESS_BATCH_MODE", True)
+    monkeypatch.setattr(func_app, "GUESS_SEND_TIMEOUT_SECONDS", 0.2)
+    sender = func_app._GuessSender("conn", func_app.GUESS_QUEUE_NAME)
+    bus.hang.set()
+
+    with pytest.raises(TimeoutError):
+        sender.send(func_app.ServiceBusMessage("{}"))
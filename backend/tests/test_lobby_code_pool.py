@@ -0,0 +1,76 @@
+import logging
+
+import pytest
+
+
+def test_pool_is_seeded_one_chunk_at_a_time(func_app, fake_redis, monkeypatch):
+    monkeypatch.setattr(func_app, "CODE_SEED_CHUNK", 100)
+
+    codes = [func_app._allocate_code()]
+    assert fake_redis.get(func_app.CODE_SEED_CURSOR_KEY) == "100"
+    assert fake_redis.scard(func_app.CODE_POOL_KEY) == 99
+
+    codes += [func_app._allocate_code() for _ in range(249)]
+    assert len(set(codes)) == len(codes)
+    # A chunk is only added once the pool drops below one
+    assert fake_redis.scard(func_app.CODE_POOL_KEY) < 2 * 100
+    assert fake_redis.zcard(func_app.CODE_LEASES_KEY) == len(codes)
+
+
+def _seeding_order(func_app, server, count: int) -> list:
+    order = server.hgetall(func_app.CODE_SEED_ORDER_KEY)
+    multiplier, offset = int(order["multiplier"]), int(order["offset"])
+    return [f"{(i * multiplier + offset) % func_app.CODE_COUNT:06d}" for i in range(count)]
+
+
+def test_seeding_skips_codes_held_by_live_lobbies(func_app, fake_redis, monkeypatch):
+    monkeypatch.setattr(func_app, "CODE_SEED_CHUNK", 10)
+    fake_redis.hset(func_app.CODE_SEED_ORDER_KEY, mapping={"multiplier": 387799, "offset": 12345})
+    first, second = _seeding_order(func_app, fake_redis, 2)
+    fake_redis.hset(f"match:{first}:meta", "host", '"host"')
+    fake_redis.hset(f"match:{second}:meta", "host", '"host"')
+
+    func_app._allocate_code()
+
+    pool = fake_redis.smembers(func_app.CODE_POOL_KEY)
+    assert first not in pool and second not in pool
+    assert fake_redis.zscore(func_app.CODE_LEASES_KEY, first) is not None
+
+
+def test_seeding_order_is_random_per_pool(func_app, fake_redis, monkeypatch):
+    monkeypatch.setattr(func_app, "CODE_SEED_CHUNK", 100)
+
+    func_app._allocate_code()
+    first_pool = _seeding_order(func_app, fake_redis, 100)
+    fixed = [f"{(i * 387799) % func_app.CODE_COUNT:06d}" for i in range(100)]
+    assert first_pool != fixed
+    assert set(first_pool) == fake_redis.smembers(func_app.CODE_POOL_KEY) | set(fake_redis.zrange(func_app.CODE_LEASES_KEY, 0, -1))
+
+    # Later chunks keep the stored order
+    order = fake_redis.hgetall(func_app.CODE_SEED_ORDER_KEY)
+    for _ in range(150):
+        func_app._allocate_code()
+    assert fake_redis.hgetall(func_app.CODE_SEED_ORDER_KEY) == order
+
+    # A fresh pool picks a different order
+    fake_redis.flushall()
+    func_app._allocate_code()
+    assert _seeding_order(func_app, fake_redis, 100) != first_pool
+
+
+def test_low_pool_is_reported_from_the_allocation(func_app, fake_redis, monkeypatch, caplog):
+    fake_redis.set(func_app.CODE_SEED_CURSOR_KEY, func_app.CODE_COUNT)
+    fake_redis.sadd(func_app.CODE_POOL_KEY, "123456", "654321")
+
+    with caplog.at_level(logging.WARNING):
+        func_app._allocate_code()
+
+    assert "Lobby code pool low: 1 free codes" in caplog.text
+
+
+def test_exhausted_pool_raises(func_app, fake_redis):
+    fake_redis.set(func_app.CODE_SEED_CURSOR_KEY, func_app.CODE_COUNT)
+
+    with pytest.raises(RuntimeError):
+        func_app._allocate_code()
+    assert fake_redis.get(func_app.CODE_EXHAUSTED_KEY) == "1"
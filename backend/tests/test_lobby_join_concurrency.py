@@ -0,0 +1,68 @@
+"""
+Hundreds of players joining one lobby at once must never overfill it or
+add anyone twice, on either lobby store.
+"""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+MATCH_ID = "777777"
+MAX_PLAYERS = 50
+JOINERS = 200
+
+
+def _seed_cosmos(func_app, containers):
+    containers["matches_container"].items[(MATCH_ID, MATCH_ID)] = {
+        "id": MATCH_ID,
+        "matchId": MATCH_ID,
+        "host": "host",
+        "players": [{"userId": "host"}],
+        "matchSettings": {"maxPlayers": MAX_PLAYERS},
+        "_etag": '"0"',
+    }
+
+
+def _seed_redis(func_app):
+    args = [func_app.LOBBY_TTL_SECONDS, "host", "host", json.dumps("host")]
+    func_app.lobby_create_script(
+        keys=func_app._lobby_keys(MATCH_ID), args=args + func_app._settings_args({"maxPlayers": MAX_PLAYERS})
+    )
+
+
+def _join_until_answered(func_app, player_id: str, start: threading.Event) -> str:
+    start.wait()
+    while True:
+        try:
+            return "joined" if func_app._lobby_join(MATCH_ID, player_id) else "not_found"
+        except func_app._LobbyConflict as e:
+            if e.status != 503:
+                return e.msg
+            # "Lobby is busy, try again", as a client would
+
+
+@pytest.mark.parametrize("store", ["cosmos", "redis"])
+def test_concurrent_joins_fill_the_lobby_exactly(request, func_app, fake_cosmos, monkeypatch, store):
+    if store == "redis":
+        request.getfixturevalue("fake_redis")
+        _seed_redis(func_app)
+    else:
+        # Widen the read-modify-write window so the ETag check is exercised
+        fake_cosmos["matches_container"].latency = 0.001
+        _seed_cosmos(func_app, fake_cosmos)
+
+    start = threading.Event()
+    with ThreadPoolExecutor(max_workers=JOINERS) as pool:
+        futures = [pool.submit(_join_until_answered, func_app, f"player-{i}", start) for i in range(JOINERS)]
+        start.set()
+        outcomes = [f.result() for f in futures]
+
+    members = [p["userId"] for p in func_app._lobby_get(MATCH_ID)["players"]]
+    assert len(members) == MAX_PLAYERS
+    assert len(set(members)) == len(members)
+    assert outcomes.count("joined") == MAX_PLAYERS - 1
+    assert outcomes.count("Lobby is full") == JOINERS - (MAX_PLAYERS - 1)
+    assert sorted(m for m in members if m != "host") == sorted(
+        f"player-{i}" for i, outcome in enumerate(outcomes) if outcome == "joined"
+    )
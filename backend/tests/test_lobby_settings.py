@@ -0,0 +1,64 @@
+import json
+
+import azure.functions as func
+import pytest
+
+MATCH_ID = "888888"
+DEFAULTS = {"noOfRounds": 3, "maxPlayers": 8, "countdown": 60}
+
+
+@pytest.fixture(params=["cosmos", "redis"])
+def lobby(request, func_app, fake_cosmos):
+    """Creates a lobby with the default settings on each store and returns its writer for raw settings."""
+    if request.param == "redis":
+        server = request.getfixturevalue("fake_redis")
+        args = [func_app.LOBBY_TTL_SECONDS, "host", "host", json.dumps("host")]
+        func_app.lobby_create_script(keys=func_app._lobby_keys(MATCH_ID), args=args + func_app._settings_args(DEFAULTS))
+
+        def write_raw(field, value):
+            server.hset(f"match:{MATCH_ID}:meta", field, json.dumps(value))
+    else:
+        container = fake_cosmos["matches_container"]
+        container.items[(MATCH_ID, MATCH_ID)] = {
+            "id": MATCH_ID, "matchId": MATCH_ID, "host": "host", "createdAt": "2026-01-01T00:00:00Z",
+            "players": [{"userId": "host"}], "matchSettings": dict(DEFAULTS), "_etag": '"0"',
+        }
+
+        def write_raw(field, value):
+            container.items[(MATCH_ID, MATCH_ID)]["matchSettings"][field] = value
+    return write_raw
+
+
+def _change_settings(func_app, match_settings: dict):
+    body = json.dumps({"matchCode": MATCH_ID, "matchSettings": match_settings}).encode()
+    response = func_app.settings(func.HttpRequest(method="PUT", url="/api/change_settings", body=body))
+    return response.status_code, json.loads(response.get_body())
+
+
+def test_settings_are_merged(func_app, lobby):
+    assert _change_settings(func_app, {"countdown": 30})[0] == 201
+
+    assert func_app._lobby_get(MATCH_ID)["matchSettings"] == {**DEFAULTS, "countdown": 30}
+
+
+def test_reserved_names_are_rejected(func_app, lobby):
+    status, body = _change_settings(func_app, {"host": "mallory", "countdown": 30})
+
+    assert status == 400
+    lobby_doc = func_app._lobby_get(MATCH_ID)
+    assert lobby_doc["host"] == "host"
+    assert lobby_doc["matchSettings"] == DEFAULTS
+
+
+def test_non_numeric_max_players_is_rejected(func_app, lobby):
+    assert _change_settings(func_app, {"maxPlayers": "lots"})[0] == 400
+
+
+@pytest.mark.parametrize("max_players", ["lots", True])
+def test_join_fails_when_max_players_is_invalid(func_app, lobby, max_players):
+    lobby("maxPlayers", max_players)
+
+    with pytest.raises(func_app._LobbyConflict) as e:
+        func_app._lobby_join(MATCH_ID, "alice")
+    assert e.value.msg == func_app.LOBBY_MAX_PLAYERS_INVALID
+    assert [p["userId"] for p in func_app._lobby_get(MATCH_ID)["players"]] == ["host"]
@@ -0,0 +1,38 @@
+import fakeredis
+import pytest
+
+from cosmos_fakes import FakeContainer
+
+
+@pytest.fixture
+def places(durable_app, monkeypatch):
+    server = fakeredis.FakeStrictRedis(decode_responses=True)
+    container = FakeContainer("/id")
+    for i in range(20):
+        container.items[(f"place-{i}", f"place-{i}")] = {
+            "id": f"place-{i}", "location": {"lat": 50.9, "lon": -1.4}, "blob": {"container": "c", "name": f"{i}.jpg"},
+        }
+    monkeypatch.setattr(durable_app, "r", server)
+    monkeypatch.setattr(durable_app, "places_col", container)
+    return server
+
+
+def test_match_gets_distinct_places_without_a_deck(durable_app, places):
+    drawn = durable_app._draw_places(5)
+
+    assert len({p["id"] for p in drawn}) == 5
+    assert places.exists(durable_app.PLACE_INDEX_READY_KEY)
+    assert not places.keys("match:*")
+
+
+def test_small_catalogue_repeats_places(durable_app, places):
+    assert len(durable_app._draw_places(25)) == 25
+
+
+def test_place_added_before_the_index_is_built_does_not_make_it_look_complete(durable_app, places):
+    # create_place wrote one id while the index was missing
+    places.sadd(durable_app.PLACE_IDS_KEY, "place-0")
+
+    durable_app._draw_places(1)
+
+    assert places.scard(durable_app.PLACE_IDS_KEY) == 20
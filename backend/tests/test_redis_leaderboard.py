@@ -0,0 +1,60 @@
+import json
+
+import azure.functions as func
+
+
+def _row(user_id: str, score: int) -> dict:
+    return {"userId": user_id, "scope": "alltime", "score": score, "displayName": user_id, "updatedAt": "2026-01-01T00:00:00Z"}
+
+
+def _leaderboard(func_app, etag=None):
+    headers = {"If-None-Match": etag} if etag else {}
+    req = func.HttpRequest(method="GET", url="/api/leaderboard", body=b"", params={"scope": "alltime", "limit": "10"}, headers=headers)
+    return func_app.leaderboard(req)
+
+
+def test_scores_only_move_up(func_app, fake_redis):
+    func_app._write_scores_to_redis([_row("alice", 300), _row("bob", 100)])
+    func_app._write_scores_to_redis([_row("alice", 200), _row("bob", 150)])
+
+    assert fake_redis.zscore("leaderboard:alltime", "alice") == 300
+    assert fake_redis.zscore("leaderboard:alltime", "bob") == 150
+
+
+def test_redis_leaderboard_sends_etag_and_304(func_app, fake_cosmos, fake_redis):
+    func_app._rebuild_redis_leaderboard("alltime")
+    func_app._write_scores_to_redis([_row("alice", 300)])
+
+    first = _leaderboard(func_app)
+    etag = first.headers["ETag"]
+    assert json.loads(first.get_body())["top"][0]["userId"] == "alice"
+    assert _leaderboard(func_app, etag).status_code == 304
+
+    # A write that doesn't move a score keeps the ETag, one that does changes it
+    func_app._write_scores_to_redis([_row("alice", 250)])
+    assert _leaderboard(func_app, etag).status_code == 304
+    func_app._write_scores_to_redis([_row("bob", 400)])
+    changed = _leaderboard(func_app, etag)
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_flushed_scope_is_served_from_cosmos_until_rebuilt(func_app, fake_cosmos, fake_redis, monkeypatch):
+    fake_cosmos["leaderboard_container"].items[("alltime", "alice")] = {"id": "alice", **_row("alice", 300)}
+    monkeypatch.setattr(func_app, "_score_scopes", lambda: {"alltime": None})
+
+    assert not func_app._redis_leaderboard_ready("alltime")
+    assert not fake_redis.exists("leaderboard:alltime")
+
+    func_app.rebuild_missing_leaderboards(None)
+
+    assert func_app._redis_leaderboard_ready("alltime")
+    assert fake_redis.zscore("leaderboard:alltime", "alice") == 300
+    assert not fake_redis.exists("leaderboard:alltime:rebuilding")
+
+
+def test_rebuild_skips_a_scope_another_worker_is_rebuilding(func_app, fake_cosmos, fake_redis):
+    fake_redis.set("leaderboard:alltime:rebuilding", "1")
+
+    assert func_app._locked_rebuild("alltime") is None
+    assert not fake_redis.exists("leaderboard:alltime:ready")
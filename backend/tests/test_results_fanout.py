@@ -0,0 +1,70 @@
+"""
+Wall time of the results endpoint against player count, with the per-player
+user lookups and score writes run on 1 worker (the old one-at-a-time
+behaviour) and on the default pool.
+
+    pytest backend/tests/test_results_fanout.py --benchmark-group-by=param:players
+"""
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.functions as func
+import pytest
+
+# Roughly a same-region Cosmos point operation
+COSMOS_LATENCY_SECONDS = 0.002
+ROUNDS_PER_GAME = 3
+
+_game_ids = itertools.count(100000)
+
+
+def _seed_players(containers, count: int) -> list:
+    player_ids = [f"player-{i}" for i in range(count)]
+    for pid in player_ids:
+        containers["users_container"].items[(pid, pid)] = {"id": pid, "username": pid, "displayName": pid, "_etag": '"0"'}
+    return player_ids
+
+
+def _seed_game(containers, player_ids: list) -> str:
+    game_id = str(next(_game_ids))
+    for round_no in range(1, ROUNDS_PER_GAME + 1):
+        doc_id = f"{game_id}_{round_no}"
+        containers["results_container"].items[(game_id, doc_id)] = {
+            "id": doc_id,
+            "game_id": game_id,
+            "round_scores": [{"player_id": pid, "data": {"score": 100}} for pid in player_ids],
+            "_ts": 0,
+        }
+    return game_id
+
+
+def _results_request(game_id: str) -> func.HttpRequest:
+    return func.HttpRequest(method="POST", url="/api/results", body=json.dumps({"game_id": game_id}).encode())
+
+
+@pytest.mark.parametrize("workers", [1, 8])
+@pytest.mark.parametrize("players", [1, 10, 50, 100])
+def test_results_wall_time(benchmark, func_app, fake_cosmos, monkeypatch, players, workers):
+    executor = ThreadPoolExecutor(max_workers=workers)
+    monkeypatch.setattr(func_app, "player_executor", executor)
+    for container in fake_cosmos.values():
+        container.latency = COSMOS_LATENCY_SECONDS
+    player_ids = _seed_players(fake_cosmos, players)
+
+    def new_game():
+        return (_results_request(_seed_game(fake_cosmos, player_ids)),), {}
+
+    responses = []
+    benchmark.pedantic(lambda req: responses.append(func_app.results(req)), setup=new_game, rounds=5, iterations=1)
+    executor.shutdown()
+
+    for response in responses:
+        body = json.loads(response.get_body())
+        assert response.status_code == 200
+        assert len(body["updated"]) == players
+        assert body["skipped"] == []
+
+    # Every game adds 100 points per round to each scope once
+    alltime = fake_cosmos["scores_container"].items[(player_ids[0], "alltime")]
+    assert alltime["score"] == len(responses) * ROUNDS_PER_GAME * 100
@@ -0,0 +1,137 @@
+import json
+import time
+
+import azure.functions as func
+
+PLAYERS = ["alice", "bob", "carol"]
+GAME_START = "2026-01-01T00:00:00Z"
+GAME_START_TS = 1767225600
+
+
+def _seed(containers, match_id: str, created_at: str, created_ts: int, score: int) -> None:
+    for pid in PLAYERS:
+        containers["users_container"].items[(pid, pid)] = {"id": pid, "username": pid, "displayName": pid, "_etag": '"0"'}
+    containers["matches_container"].items[(match_id, match_id)] = {
+        "id": match_id,
+        "matchId": match_id,
+        "createdAt": created_at,
+        "players": [{"userId": pid} for pid in PLAYERS],
+        "matchSettings": {},
+        "_etag": '"0"',
+    }
+    for round_no in (1, 2):
+        doc_id = f"{match_id}_{created_ts}_{round_no}"
+        containers["results_container"].items[(match_id, doc_id)] = {
+            "id": doc_id,
+            "game_id": match_id,
+            "round_scores": [{"player_id": pid, "data": {"score": score}} for pid in PLAYERS],
+            "_ts": created_ts + 60 * round_no,
+        }
+
+
+def _results(func_app, match_id: str):
+    req = func.HttpRequest(method="POST", url="/api/results", body=json.dumps({"game_id": match_id}).encode())
+    response = func_app.results(req)
+    return response.status_code, json.loads(response.get_body())
+
+
+def _alltime(containers, pid: str) -> int:
+    return containers["scores_container"].items[(pid, "alltime")]["score"]
+
+
+def _finalization(containers, match_id: str, created_at: str = GAME_START) -> dict:
+    key = f"{match_id}:{created_at}"
+    return containers["finalizations_container"].items[(key, key)]
+
+
+def test_retry_returns_stored_response(func_app, fake_cosmos):
+    _seed(fake_cosmos, "111111", GAME_START, GAME_START_TS, 100)
+
+    first = _results(func_app, "111111")
+    second = _results(func_app, "111111")
+
+    assert first[0] == 200
+    assert second == first
+    assert all(_alltime(fake_cosmos, pid) == 200 for pid in PLAYERS)
+
+
+def test_stale_claim_is_taken_over_without_reapplying(func_app, fake_cosmos, monkeypatch):
+    _seed(fake_cosmos, "222222", GAME_START, GAME_START_TS, 100)
+
+    # Scores land, then the worker fails before it can record the outcome
+    with monkeypatch.context() as m:
+        m.setattr(func_app, "_complete_finalization", lambda *args: (_ for _ in ()).throw(TimeoutError("timed out")))
+        assert _results(func_app, "222222")[0] == 500
+
+    # Held by the (dead) claimant until its lease runs out
+    assert _results(func_app, "222222")[0] == 409
+    record = _finalization(fake_cosmos, "222222")
+    record["leaseUntil"] = time.time() - 1
+
+    status, body = _results(func_app, "222222")
+    assert status == 200
+    assert len(body["updated"]) == len(PLAYERS)
+    assert all(_alltime(fake_cosmos, pid) == 200 for pid in PLAYERS)
+    assert _finalization(fake_cosmos, "222222")["status"] == "completed"
+
+
+def test_failed_players_are_retried_alone(func_app, fake_cosmos, monkeypatch):
+    _seed(fake_cosmos, "333333", GAME_START, GAME_START_TS, 100)
+    inc_scores = func_app._inc_scores
+    failures = {"bob": 1}
+
+    def flaky_inc_scores(user_id, *args):
+        if failures.get(user_id):
+            failures[user_id] -= 1
+            raise RuntimeError("throttled")
+        return inc_scores(user_id, *args)
+
+    monkeypatch.setattr(func_app, "_inc_scores", flaky_inc_scores)
+
+    status, body = _results(func_app, "333333")
+    assert status == 200
+    assert body["skipped"] == [{"player_id": "bob", "reason": "score_update_failed"}]
+    assert ("bob", "alltime") not in fake_cosmos["scores_container"].items
+    assert _finalization(fake_cosmos, "333333")["status"] == "pending"
+
+    status, body = _results(func_app, "333333")
+    assert status == 200
+    assert body["skipped"] == []
+    assert all(_alltime(fake_cosmos, pid) == 200 for pid in PLAYERS)
+    assert _finalization(fake_cosmos, "333333")["status"] == "completed"
+
+
+def test_reused_code_is_finalized_as_a_new_game(func_app, fake_cosmos):
+    _seed(fake_cosmos, "444444", GAME_START, GAME_START_TS, 100)
+    assert _results(func_app, "444444")[0] == 200
+
+    # The code goes back to the pool and a new lobby gets it
+    later, later_ts = "2026-01-01T01:00:00Z", GAME_START_TS + 3600
+    _seed(fake_cosmos, "444444", later, later_ts, 30)
+    status, body = _results(func_app, "444444")
+
+    assert status == 200
+    assert body["totals"] == {pid: 60 for pid in PLAYERS}
+    assert all(_alltime(fake_cosmos, pid) == 200 + 60 for pid in PLAYERS)
+    assert _finalization(fake_cosmos, "444444", later)["status"] == "completed"
+
+
+def test_finished_game_retry_resolves_after_lobby_is_gone(func_app, fake_cosmos):
+    _seed(fake_cosmos, "555555", GAME_START, GAME_START_TS, 100)
+    first = _results(func_app, "555555")
+
+    assert ("555555", "555555") not in fake_cosmos["matches_container"].items
+    assert _results(func_app, "555555") == first
+
+
+def test_finished_game_retry_is_one_finalization_read(func_app, fake_cosmos):
+    _seed(fake_cosmos, "999999", GAME_START, GAME_START_TS, 100)
+    first = _results(func_app, "999999")
+    for container in fake_cosmos.values():
+        container.calls = 0
+
+    assert _results(func_app, "999999") == first
+    # The (Cosmos) lobby read that finds the lobby gone, then the stored outcome
+    assert fake_cosmos["matches_container"].calls == 1
+    assert fake_cosmos["finalizations_container"].calls == 1
+    assert fake_cosmos["results_container"].calls == 0
@@ -0,0 +1,30 @@
+import datetime
+
+import pytest
+
+
+@pytest.fixture
+def scopes(func_app, monkeypatch):
+    monkeypatch.setattr(func_app, "SCORE_SCOPES", dict(func_app.SCORE_SCOPES))
+    return func_app.SCORE_SCOPES
+
+
+@pytest.mark.parametrize("raw", ["not json", '{"name": "x"}', "null"])
+def test_malformed_seasons_setting_is_ignored(func_app, scopes, raw):
+    before = dict(scopes)
+    func_app._register_seasons(raw)
+    assert scopes == before
+
+
+def test_invalid_season_is_skipped_and_the_rest_registered(func_app, scopes):
+    func_app._register_seasons(
+        '[{"name": "bad", "start": "March", "end": "2026-06-01"},'
+        ' {"name": "missing-end", "start": "2026-03-01"},'
+        ' "spring",'
+        ' {"name": "spring-2026", "start": "2026-03-01", "end": "2026-06-01"}]'
+    )
+
+    assert "season:bad" not in scopes
+    assert "season:missing-end" not in scopes
+    now = datetime.datetime(2026, 4, 1, tzinfo=datetime.timezone.utc)
+    assert func_app._score_scopes(now)["season:spring-2026"] is None
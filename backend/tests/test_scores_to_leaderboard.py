@@ -0,0 +1,39 @@
+import logging
+import re
+
+
+def _score_doc(user_id: str, scope: str, score: int, updated_at: str) -> dict:
+    return {"id": scope, "userId": user_id, "scope": scope, "score": score, "displayName": user_id, "updatedAt": updated_at}
+
+
+def _counts(caplog) -> dict:
+    line = next(rec.getMessage() for rec in caplog.records if rec.getMessage().startswith("scores_to_leaderboard:"))
+    return {k: int(v) for k, v in re.findall(r"(\w+)=(\d+)", line)}
+
+
+def test_counts_keep_parse_and_write_failures_apart(func_app, fake_cosmos, monkeypatch, caplog):
+    write_rows = func_app._write_leaderboard_rows
+    # Every row for the month scope is rejected by Cosmos
+    monkeypatch.setattr(func_app, "_write_leaderboard_rows", lambda scope, rows: [] if scope.startswith("month") else write_rows(scope, rows))
+
+    documents = [
+        _score_doc("alice", "alltime", 100, "2026-01-01T00:00:00Z"),
+        _score_doc("alice", "alltime", 250, "2026-01-01T00:01:00Z"),
+        _score_doc("bob", "alltime", 80, "2026-01-01T00:00:00Z"),
+        _score_doc("alice", "month:2026-01", 250, "2026-01-01T00:01:00Z"),
+        _score_doc("bob", "month:2026-01", 80, "2026-01-01T00:00:00Z"),
+        {"id": "broken", "userId": "carol"},
+        {"id": "applied:123456:x", "userId": "alice", "type": "applied"},
+    ]
+    with caplog.at_level(logging.INFO):
+        func_app.scores_to_leaderboard(documents)
+
+    assert _counts(caplog) == {
+        "received": 7,
+        "ignored": 1,
+        "parse_failed": 1,
+        "coalesced": 1,
+        "written": 2,
+        "write_failed": 2,
+    }
+    assert fake_cosmos["leaderboard_container"].items[("alltime", "alice")]["score"] == 250
@@ -0,0 +1,89 @@
+"""
+Checks the vectorised scoring kernel against the per-guess functions it
+replaced, and benchmarks both from 1 to 1M guesses in one round.
+
+    pytest backend/tests/test_scoring_kernel.py --benchmark-group-by=param:guesses
+"""
+import numpy as np
+import pytest
+
+ANSWER = (50.9352, -1.3960)  # Highfield campus
+PROFILE = "city-strict"
+
+
+def _guesses(count: int, seed: int = 7):
+    # Spread around the answer like real guesses: most within a few km, some far off
+    rng = np.random.default_rng(seed)
+    lats = ANSWER[0] + rng.normal(0, 0.02, count)
+    lons = ANSWER[1] + rng.normal(0, 0.03, count)
+    far = rng.random(count) < 0.05
+    lats[far] = rng.uniform(-89, 89, far.sum())
+    lons[far] = rng.uniform(-180, 180, far.sum())
+    return lats, lons
+
+
+def _scalar_score(app, distance_km: float, profile_name: str) -> int:
+    profile = app.SCORING_PROFILES[profile_name]
+    if profile["curve"] == "exp":
+        return app.score_city(distance_km, profile["max_score"], profile["scale_km"])
+    score = int(round(profile["max_score"] - distance_km / profile["scale_km"]))
+    return max(0, min(profile["max_score"], score))
+
+
+def _score_scalar(app, lats, lons):
+    distances = [app.calculate_distance(lat, lon, *ANSWER) for lat, lon in zip(lats, lons)]
+    return distances, [_scalar_score(app, d, PROFILE) for d in distances]
+
+
+def _score_vector(app, lats, lons):
+    return app.score_guesses(lats, lons, *ANSWER, PROFILE)
+
+
+def test_batch_distances_match_scalar(background_app):
+    lats, lons = _guesses(100_000)
+
+    batch = background_app.calculate_distance_batch(lats, lons, *ANSWER)
+    scalar = [background_app.calculate_distance(lat, lon, *ANSWER) for lat, lon in zip(lats, lons)]
+
+    np.testing.assert_allclose(batch, scalar, rtol=0, atol=1e-9)
+
+
+def test_batch_distances_match_scalar_per_guess_answers(background_app):
+    lats, lons = _guesses(1_000, seed=1)
+    ans_lats, ans_lons = _guesses(1_000, seed=2)
+
+    batch = background_app.calculate_distance_batch(lats, lons, ans_lats, ans_lons)
+    scalar = [background_app.calculate_distance(*args) for args in zip(lats, lons, ans_lats, ans_lons)]
+
+    np.testing.assert_allclose(batch, scalar, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize("profile_name", ["city-strict", "city-forgiving", "linear", "region"])
+def test_profile_scores_match_scalar(background_app, profile_name):
+    lats, lons = _guesses(100_000)
+    distances = background_app.calculate_distance_batch(lats, lons, *ANSWER)
+
+    batch = background_app.score_with_profile(distances, profile_name)
+    scalar = np.array([_scalar_score(background_app, d, profile_name) for d in distances])
+
+    # The lookup table is within ~0.01 points of exp(), so a score can only
+    # differ where the exact value sits right on a .5 and rounds the other way
+    assert np.abs(batch - scalar).max() <= 1
+    assert np.count_nonzero(batch != scalar) <= len(scalar) // 1000
+
+
+@pytest.mark.parametrize("kernel", ["scalar", "vector"])
+@pytest.mark.parametrize("guesses", [1, 100, 10_000, 1_000_000])
+def test_round_scoring_time(benchmark, background_app, guesses, kernel):
+    lats, lons = _guesses(guesses)
+    if kernel == "scalar":
+        # The scalar path ran on Python floats, one guess at a time
+        lats, lons = lats.tolist(), lons.tolist()
+        score = _score_scalar
+    else:
+        score = _score_vector
+    rounds = 1 if guesses >= 1_000_000 else 5
+
+    distances, scores = benchmark.pedantic(score, args=(background_app, lats, lons), rounds=rounds, iterations=1)
+
+    assert len(distances) == len(scores) == guesses
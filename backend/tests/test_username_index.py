@@ -0,0 +1,64 @@
+import json
+import time
+
+import azure.functions as func
+
+
+def _register(func_app, username: str):
+    body = json.dumps({"username": username, "password": "hunter2"}).encode()
+    response = func_app.register(func.HttpRequest(method="POST", url="/api/register", body=body))
+    return response.status_code
+
+
+def _orphan(containers, username: str, age_seconds: float) -> None:
+    # A registration reserved the name, then died before creating its user
+    containers["usernames_container"].items[(username, username)] = {
+        "id": username, "username": username, "userId": "ghost", "_etag": '"0"', "_ts": int(time.time() - age_seconds),
+    }
+
+
+def test_orphaned_reservation_is_reclaimed(func_app, fake_cosmos):
+    _orphan(fake_cosmos, "alice", func_app.USERNAME_RESERVATION_SECONDS + 1)
+
+    assert _register(func_app, "alice") == 201
+    assert func_app._get_user_by_username("alice")["username"] == "alice"
+
+
+def test_recent_reservation_is_left_to_its_registration(func_app, fake_cosmos):
+    _orphan(fake_cosmos, "alice", 0)
+
+    assert _register(func_app, "alice") == 409
+    assert fake_cosmos["usernames_container"].items[("alice", "alice")]["userId"] == "ghost"
+
+
+def test_taken_username_is_not_reclaimed(func_app, fake_cosmos):
+    assert _register(func_app, "alice") == 201
+    entry = fake_cosmos["usernames_container"].items[("alice", "alice")]
+    entry["_ts"] -= func_app.USERNAME_RESERVATION_SECONDS + 1
+
+    assert _register(func_app, "alice") == 409
+
+
+def test_stale_cached_mapping_is_dropped(func_app, fake_cosmos):
+    assert _register(func_app, "alice") == 201
+    # Cached by another lookup before the name was reclaimed
+    func_app.username_cache.set("alice", "ghost")
+
+    assert func_app._get_user_by_username("alice")["username"] == "alice"
+
+
+def test_unknown_username_queries_users_once(func_app, fake_cosmos):
+    users = fake_cosmos["users_container"]
+
+    assert func_app._get_user_by_username("nobody") is None
+    calls = users.calls
+    assert func_app._get_user_by_username("nobody") is None
+
+    assert users.calls == calls
+
+
+def test_unknown_username_found_once_registered(func_app, fake_cosmos):
+    assert func_app._get_user_by_username("alice") is None
+
+    assert _register(func_app, "alice") == 201
+    assert func_app._get_user_by_username("alice")["username"] == "alice"
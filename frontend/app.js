@@ -699,7 +699,7 @@ function startGameOrchestratorAPI(game){
 
     //Needs to be fixed next - currently calling back end not durable function - I think this issue was casued when the backend request function was added.
     backendRequest('POST', '/start_game_trigger', {
-        body: { game_id: game, rounds: numRounds, time: timeRounds }
+        body: { game_id: game, rounds: numRounds, time: timeRounds, scoringProfile: settings['scoringProfile'] }
     }, function(err, response, body){
         if (err){
             console.log("Error starting orchestrator:", err);